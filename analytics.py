@@ -0,0 +1,84 @@
+# analytics.py
+"""Spending analytics served from the MonthlyRollup table.
+
+MonthlyRollup holds planned, spent and transaction counts per user, year,
+month and category. Triggers on CategoryTotals (migration 4) keep it current
+on every write, so trend and year-over-year questions read a handful of rows
+per month instead of every transaction the user has. rebuild_rollups()
+recomputes it from the raw Expense/Transaction rows.
+"""
+from db import install_views, transaction
+from totals import EXPECTED_CATEGORY_TOTALS
+
+
+def months_back(year, month, count):
+    """The (year, month) `count - 1` months before the given one."""
+    index = year * 12 + (month - 1) - (count - 1)
+    return index // 12, index % 12 + 1
+
+
+def monthly_trend(db, user_id, start, end, category=None):
+    """Planned/spent/count per month from `start` to `end` inclusive, both (year, month)."""
+    rows = db.execute("""
+        SELECT Year, Month,
+               SUM(Planned) AS Planned, SUM(Spent) AS Spent,
+               SUM(TransactionCount) AS Transactions
+        FROM MonthlyRollup
+        WHERE UserID = :user_id
+          AND (Year, Month) >= (:start_year, :start_month)
+          AND (Year, Month) <= (:end_year, :end_month)
+          AND (:category IS NULL OR Category = :category)
+        GROUP BY Year, Month
+        ORDER BY Year, Month
+    """, {'user_id': user_id, 'start_year': start[0], 'start_month': start[1],
+          'end_year': end[0], 'end_month': end[1], 'category': category})
+    return [dict(row) for row in rows]
+
+
+def year_over_year(db, user_id, year, category=None):
+    """Spending per month of `year` next to the same month of the year before."""
+    rows = db.execute("""
+        SELECT Month,
+               SUM(CASE WHEN Year = :year THEN Spent ELSE 0 END) AS Spent,
+               SUM(CASE WHEN Year = :year - 1 THEN Spent ELSE 0 END) AS PreviousYearSpent
+        FROM MonthlyRollup
+        WHERE UserID = :user_id
+          AND Year IN (:year - 1, :year)
+          AND (:category IS NULL OR Category = :category)
+        GROUP BY Month
+        ORDER BY Month
+    """, {'user_id': user_id, 'year': year, 'category': category})
+    return [dict(row) for row in rows]
+
+
+def category_breakdown(db, user_id, start, end):
+    """Planned and spent per category over the period from `start` to `end`."""
+    rows = db.execute("""
+        SELECT Category, SUM(Planned) AS Planned, SUM(Spent) AS Spent,
+               SUM(TransactionCount) AS Transactions
+        FROM MonthlyRollup
+        WHERE UserID = :user_id
+          AND (Year, Month) >= (:start_year, :start_month)
+          AND (Year, Month) <= (:end_year, :end_month)
+        GROUP BY Category
+        ORDER BY Spent DESC
+    """, {'user_id': user_id, 'start_year': start[0], 'start_month': start[1],
+          'end_year': end[0], 'end_month': end[1]})
+    return [dict(row) for row in rows]
+
+
+def rebuild_rollups(db):
+    """Recompute MonthlyRollup from the raw rows in one transaction."""
+    install_views(db)
+    with transaction(db):
+        db.execute("DELETE FROM MonthlyRollup")
+        db.execute(f"""
+            INSERT INTO MonthlyRollup
+                (UserID, Year, Month, Category, Planned, Spent, TransactionCount)
+            SELECT b.UserID, b.Year, CAST(b.Month AS INTEGER), totals.Category,
+                   SUM(totals.Planned), SUM(totals.Spent), SUM(totals.TransactionCount)
+            FROM ({EXPECTED_CATEGORY_TOTALS}) AS totals
+            JOIN Budget b ON b.BudgetID = totals.BudgetID
+            WHERE b.UserID IS NOT NULL
+            GROUP BY b.UserID, b.Year, CAST(b.Month AS INTEGER), totals.Category
+        """)
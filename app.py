@@ -1,17 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, session, g, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, make_response, Response, stream_with_context
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
 import re
 import os
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import date
 import calendar
+import functools
+import hashlib
+import io
 from flask_login import login_required
 from flask_login import LoginManager
 from flask_login import login_user 
 from flask_login import login_required, current_user 
 from flask_login import logout_user
-from models import User  
+from models import User, USER_COLUMNS
+from cache import LRUCache, create_cache
+from migrations import migrate, schema_version
+from db import get_db, get_directory, close_db, run_query, transaction
+import db as database
+import instrumentation
+import limits
+import budgets
+import archive
+import auth
+import ledger
+import assets
+import shards
+import exports
+import reports
+from totals import reconcile
+from dashboard_data import (load_budget_charts, load_dashboard, load_history, transactions_page,
+                            PAGE_SIZE)
+from search import search_transactions
+from importer import import_transactions, parse_csv, parse_ofx
+from rewards import settle_rewards
+from analytics import (category_breakdown, monthly_trend, months_back, rebuild_rollups,
+                       year_over_year)
+import click
 
 
 # Load environment variables
@@ -19,33 +44,381 @@ load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "your_secret_key")
-DATABASE = r'C:\SET\Smart Expense Tracker\database\smartexpense.db'
+app.config.update(
+    DATABASE=os.getenv("SMARTEX_DATABASE",
+                       os.path.join(app.root_path, 'database', 'smartexpense.db')),
+    SQLITE_BUSY_TIMEOUT_MS=int(os.getenv("SMARTEX_SQLITE_BUSY_TIMEOUT_MS",
+                                         database.DEFAULT_BUSY_TIMEOUT_MS)),
+    SQLITE_MMAP_SIZE=int(os.getenv("SMARTEX_SQLITE_MMAP_SIZE", database.DEFAULT_MMAP_SIZE)),
+    SQLITE_CACHE_SIZE_KB=int(os.getenv("SMARTEX_SQLITE_CACHE_SIZE_KB",
+                                       database.DEFAULT_CACHE_SIZE_KB)),
+    USER_CACHE_SIZE=int(os.getenv("SMARTEX_USER_CACHE_SIZE", 10000)),
+    USER_CACHE_TTL=int(os.getenv("SMARTEX_USER_CACHE_TTL", 300)),
+    # 'memory' is per worker process; use 'redis' when running several workers
+    PAGE_CACHE_BACKEND=os.getenv("SMARTEX_PAGE_CACHE_BACKEND", "memory"),
+    PAGE_CACHE_SIZE=int(os.getenv("SMARTEX_PAGE_CACHE_SIZE", 2048)),
+    PAGE_CACHE_TTL=int(os.getenv("SMARTEX_PAGE_CACHE_TTL", 3600)),
+    REDIS_URL=os.getenv("SMARTEX_REDIS_URL", "redis://localhost:6379/0"),
+    SQL_INSTRUMENTATION=os.getenv("SMARTEX_SQL_INSTRUMENTATION", "0") == "1",
+    SLOW_QUERY_MS=float(os.getenv("SMARTEX_SLOW_QUERY_MS", 100)),
+    # Threads the async /api/v1 views run their queries on
+    QUERY_POOL_SIZE=int(os.getenv("SMARTEX_QUERY_POOL_SIZE", database.DEFAULT_QUERY_POOL_SIZE)),
+    # Cold store for old transactions; unset disables archival
+    ARCHIVE_DATABASE=os.getenv("SMARTEX_ARCHIVE_DATABASE") or None,
+    ARCHIVE_AFTER_MONTHS=int(os.getenv("SMARTEX_ARCHIVE_AFTER_MONTHS", 24)),
+    # werkzeug method string: algorithm and cost, e.g. 'pbkdf2:sha256:600000'
+    AUTH_HASH_METHOD=os.getenv("SMARTEX_AUTH_HASH_METHOD", auth.DEFAULT_METHOD),
+    # Processes hashing runs in; 0 hashes on the request thread
+    AUTH_HASH_WORKERS=int(os.getenv("SMARTEX_AUTH_HASH_WORKERS", auth.DEFAULT_WORKERS)),
+    AUTH_MAX_CONCURRENT_HASHES=int(os.getenv("SMARTEX_AUTH_MAX_CONCURRENT_HASHES",
+                                             auth.DEFAULT_MAX_CONCURRENT)),
+    AUTH_HASH_WAIT_SECONDS=float(os.getenv("SMARTEX_AUTH_HASH_WAIT_SECONDS",
+                                           auth.DEFAULT_WAIT_SECONDS)),
+    AUTH_FAILED_LOGIN_BURST=int(os.getenv("SMARTEX_AUTH_FAILED_LOGIN_BURST",
+                                          auth.DEFAULT_FAILED_LOGIN_BURST)),
+    AUTH_FAILED_LOGIN_REFILL_SECONDS=float(os.getenv("SMARTEX_AUTH_FAILED_LOGIN_REFILL_SECONDS",
+                                                     auth.DEFAULT_FAILED_LOGIN_REFILL_SECONDS)),
+    # Output of `flask build-assets`, served from /assets/ with immutable caching
+    ASSETS_FOLDER=os.getenv("SMARTEX_ASSETS_FOLDER", os.path.join(app.static_folder, 'dist')),
+    # Unfingerprinted /static/ files can change in place, so only cache them briefly
+    SEND_FILE_MAX_AGE_DEFAULT=int(os.getenv("SMARTEX_STATIC_MAX_AGE", 3600)),
+    # name=path,... of the databases users' data is spread over; unset keeps it all in DATABASE
+    SHARDS=shards.parse_shards(os.getenv("SMARTEX_SHARDS")),
+    # Where `flask generate-reports` writes the month-close reports
+    REPORTS_FOLDER=os.getenv("SMARTEX_REPORTS_FOLDER", os.path.join(app.instance_path, 'reports')),
+    REPORT_WORKERS=int(os.getenv("SMARTEX_REPORT_WORKERS", reports.DEFAULT_WORKERS)),
+)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
+login_manager.login_view = 'login'
+
+# Users by id, so authenticated requests don't each query the User table
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
 
 @login_manager.user_loader
 def load_user(user_id):
-    db = get_db()
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    db = get_directory()
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM User WHERE UserID = ?", (user_id,))
+    cursor.execute(f"SELECT {USER_COLUMNS} FROM User WHERE UserID = ?", (user_id,))
     user_row = cursor.fetchone()
     if user_row:
-        return User(user_row)
+        user = User(user_row)
+        user_cache.set(user_id, user)
+        return user
     return None
 
 
-def get_db():
-    if not hasattr(g, 'sqlite_db'):
-        db = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-        g.sqlite_db = db
-    return g.sqlite_db
+# Password hashing runs in a process pool; failed logins are throttled per username
+password_hasher = auth.PasswordHasher(app.config['AUTH_HASH_METHOD'],
+                                      app.config['AUTH_HASH_WORKERS'],
+                                      app.config['AUTH_MAX_CONCURRENT_HASHES'],
+                                      app.config['AUTH_HASH_WAIT_SECONDS'])
+login_limiter = auth.FailedLoginLimiter(app.config['AUTH_FAILED_LOGIN_BURST'],
+                                        app.config['AUTH_FAILED_LOGIN_REFILL_SECONDS'])
+
+
+def invalidate_user(user_id):
+    """Drop a cached user; call after any write to their User row."""
+    user_cache.delete(str(user_id))
+
+
+# Rendered history and chart pages, keyed by user and budget
+page_cache = create_cache(app.config['PAGE_CACHE_BACKEND'], app.config['PAGE_CACHE_SIZE'],
+                          app.config['PAGE_CACHE_TTL'], app.config['REDIS_URL'])
+
+instrumentation.init_app(app, caches={'user': user_cache, 'page': page_cache})
+
+def page_owner(user_id):
+    """Cache key part for `user_id`'s pages; sharded, it names the shard, as a move renumbers budgets."""
+    if not app.config['SHARDS']:
+        return str(user_id)
+    return f"{user_id}@{database.current_shard()}"
+
+def history_cache_key():
+    return f"history:{page_owner(current_user.id)}"
+
+def charts_cache_key(budget_id):
+    return f"charts:{page_owner(current_user.id)}:{budget_id}"
+
+def invalidate_pages(user_id, budget_id=None):
+    """Drop cached pages that show data for `user_id` (and `budget_id`, when given)."""
+    page_cache.delete(f"history:{page_owner(user_id)}")
+    if budget_id is not None:
+        page_cache.delete(f"charts:{page_owner(user_id)}:{budget_id}")
+
+def cached_page(make_key, mimetype='text/html'):
+    """Serve the view's rendered body from page_cache, with an ETag so browsers can get a 304.
+
+    Only successful renders (str results) are cached; redirects and errors pass
+    straight through. The view may be sync or async.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = make_key(*args, **kwargs)
+            entry = page_cache.get(key)
+            if entry is None:
+                body = app.ensure_sync(view)(*args, **kwargs)
+                if not isinstance(body, str):
+                    return body
+                entry = {'etag': hashlib.sha1(body.encode()).hexdigest(), 'body': body}
+                page_cache.set(key, entry)
+            response = make_response(entry['body'])
+            response.mimetype = mimetype
+            response.set_etag(entry['etag'])
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+app.teardown_appcontext(close_db)
+
+# Vendored files already reported missing, so each is logged once per process
+missing_vendor_logged = set()
+
+@app.template_global()
+def asset_urls(bundle):
+    """URLs a page includes for `bundle`: the built file, or its sources before a build.
+
+    A vendored source that hasn't been fetched into static/ yet comes from its
+    pinned CDN URL, logged once, so the pages keep working until the next
+    `flask build-assets` (which fetches it).
+    """
+    built = assets.load_manifest(app.config['ASSETS_FOLDER']).get(bundle)
+    if built:
+        return [url_for('asset', filename=built)]
+    urls = []
+    for source in assets.BUNDLES[bundle]:
+        if source in assets.VENDOR and not os.path.isfile(os.path.join(app.static_folder, source)):
+            if source not in missing_vendor_logged:
+                missing_vendor_logged.add(source)
+                app.logger.warning("static/%s is missing, linking %s instead; run "
+                                   "`flask build-assets`", source, assets.VENDOR[source])
+            urls.append(assets.VENDOR[source])
+        else:
+            urls.append(url_for('static', filename=source))
+    return urls
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    return assets.send_asset(app.config['ASSETS_FOLDER'], filename, request.accept_encodings)
+
+def shard_label(name):
+    """Prefix for CLI output about shard `name`; empty when the app isn't sharded."""
+    return f"[{name}] " if app.config['SHARDS'] else ""
+
+@app.cli.command('migrate')
+@click.option('--target', type=int, default=None, help='Stop at this schema version.')
+def migrate_command(target):
+    """Apply pending schema migrations to the directory and every shard."""
+    paths = {'directory': app.config['DATABASE']}
+    for name, path in shards.shard_paths(app.config).items():
+        if path not in paths.values():
+            paths[name] = path
+    for name, path in paths.items():
+        db = database.connect(path, auto_migrate=False)
+        try:
+            label = shard_label(name)
+            for version, description in migrate(db, target):
+                click.echo(f"{label}Applied migration {version}: {description}")
+            click.echo(f"{label}Schema is at version {schema_version(db)}.")
+        finally:
+            db.close()
 
-@app.teardown_appcontext
-def close_db(error):
-    if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+@app.cli.command('reconcile-totals')
+@click.option('--dry-run', is_flag=True, help='Report drift without rebuilding the totals.')
+def reconcile_totals_command(dry_run):
+    """Check BudgetTotals/CategoryTotals against the raw rows and rebuild on drift."""
+    for name, drift in shards.fan_out(app.config, reconcile, not dry_run).items():
+        label = shard_label(name)
+        for entry in drift:
+            key = f"budget {entry['BudgetID']}"
+            if 'Category' in entry:
+                key += f" / {entry['Category']!r}"
+            click.echo(f"{label}{entry['table']} {key}: {entry['column']} "
+                       f"expected {entry['expected']}, found {entry['actual']}")
+        if not drift:
+            click.echo(f"{label}Totals are in sync.")
+        elif not dry_run:
+            click.echo(f"{label}Rebuilt totals ({len(drift)} mismatches).")
+
+@app.cli.command('import-transactions')
+@click.argument('budget_id', type=int)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ofx']), default=None,
+              help='File format (defaults to the file extension).')
+@click.option('--category', default='', help='Category assigned to OFX rows.')
+@click.option('--shard', default=database.DEFAULT_SHARD, show_default=True,
+              help='Shard holding the budget.')
+def import_transactions_command(budget_id, path, file_format, category, shard):
+    """Import a bank statement into a budget."""
+    shard_path = shards.shard_paths(app.config).get(shard)
+    if shard_path is None:
+        raise click.ClickException(f"No shard named {shard!r}.")
+    file_format = file_format or ('ofx' if path.lower().endswith(('.ofx', '.qfx')) else 'csv')
+    db = database.open_database(app.config, shard_path)
+    try:
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            rows = parse_ofx(stream, category) if file_format == 'ofx' else parse_csv(stream)
+            try:
+                result = import_transactions(db, budget_id, rows)
+            except LookupError as e:
+                raise click.ClickException(str(e))
+    finally:
+        db.close()
+    for line, reason in result.rejected:
+        click.echo(f"line {line}: {reason}")
+    click.echo(f"Imported {result.imported} transactions, rejected {len(result.rejected)}.")
+
+@app.cli.command('settle-rewards')
+@click.option('--date', 'as_of', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Settle budgets closed before this date (default: today).')
+@click.option('--batch-size', type=int, default=1000, show_default=True)
+def settle_rewards_command(as_of, batch_size):
+    """Insert rewards for every closed budget that doesn't have one yet."""
+    for name, settled in shards.fan_out(app.config, settle_rewards,
+                                        as_of.date() if as_of else None, batch_size).items():
+        click.echo(f"{shard_label(name)}Settled {settled} rewards.")
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the monthly analytics rollups from the raw rows."""
+    for name in shards.fan_out(app.config, rebuild_rollups):
+        click.echo(f"{shard_label(name)}Rebuilt monthly rollups.")
+
+@app.cli.command('replay-ledger')
+@click.option('--full', is_flag=True, help='Discard the replay and start again from the first event.')
+@click.option('--apply', 'apply_changes', is_flag=True,
+              help='Correct the live totals wherever they differ from the replay.')
+@click.option('--chunk-size', type=int, default=ledger.CHUNK_SIZE, show_default=True)
+def replay_ledger_command(full, apply_changes, chunk_size):
+    """Replay the event ledger into the shadow totals, resuming from the checkpoint."""
+    def replay(db):
+        if full:
+            ledger.reset_replay(db)
+        replayed = ledger.catch_up(db, chunk_size)
+        lines = [f"Replayed {replayed} events; checkpoint at event {ledger.checkpoint(db)}."]
+        if apply_changes:
+            lines += [f"Corrected {rows} {table} rows."
+                      for table, rows in ledger.apply_replay(db, chunk_size).items()]
+        return lines
+
+    for name, lines in shards.fan_out(app.config, replay).items():
+        for line in lines:
+            click.echo(shard_label(name) + line)
+
+@app.cli.command('forecast-spending')
+@click.option('--date', 'as_of', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Forecast budgets of this date\'s month, as of that day (default: today).')
+@click.option('--batch-size', type=int, default=None,
+              help='Budgets per batch (default: forecast.BATCH_SIZE).')
+def forecast_spending_command(as_of, batch_size):
+    """Project month-end spending of every active budget and flag overspend."""
+    import forecast  # needs NumPy, which only the batch job uses
+    results = shards.fan_out(app.config, forecast.forecast_spending,
+                             as_of.date() if as_of else None, batch_size or forecast.BATCH_SIZE)
+    for name, (budget_count, series, flagged) in results.items():
+        click.echo(f"{shard_label(name)}Forecast {series} categories across {budget_count} "
+                   f"budgets; {flagged} projected to overspend.")
+
+@app.cli.command('archive-transactions')
+@click.option('--months', type=int, default=None,
+              help='Archive budgets older than this many months (default: ARCHIVE_AFTER_MONTHS).')
+@click.option('--batch-size', type=int, default=archive.BATCH_SIZE, show_default=True)
+@click.option('--vacuum', is_flag=True, help='VACUUM the hot database afterwards to shrink it.')
+def archive_transactions_command(months, batch_size, vacuum):
+    """Move transactions of old budgets into the archive database."""
+    if not app.config['ARCHIVE_DATABASE']:
+        raise click.ClickException("ARCHIVE_DATABASE is not set.")
+    months = months or app.config['ARCHIVE_AFTER_MONTHS']
+    today = date.today()
+    before = months_back(today.year, today.month, months + 1)
+
+    def archive_shard(db):
+        result = archive.archive_budgets(db, before, batch_size)
+        if vacuum:
+            db.execute("VACUUM")
+        return result
+
+    for name, (budgets_archived, moved) in shards.fan_out(app.config, archive_shard).items():
+        click.echo(f"{shard_label(name)}Archived {moved} transactions from {budgets_archived} "
+                   f"budgets before {before[0]}-{before[1]:02d}.")
+
+@app.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help='List the users that would move.')
+@click.option('--limit', type=int, default=None, help='Move at most this many users.')
+def rebalance_shards_command(dry_run, limit):
+    """Move users whose shard isn't the one consistent hashing assigns them."""
+    if not app.config['SHARDS']:
+        raise click.ClickException("SHARDS is not set.")
+    moves = shards.rebalance(app.config, limit, dry_run)
+    for user_id, source, target in moves:
+        click.echo(f"user {user_id}: {source} -> {target}")
+    click.echo(f"{'Would move' if dry_run else 'Moved'} {len(moves)} users.")
+
+@app.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+def move_user_command(user_id, shard):
+    """Move one user's data to SHARD."""
+    if not app.config['SHARDS']:
+        raise click.ClickException("SHARDS is not set.")
+    try:
+        moved = database.retry_on_busy(lambda: shards.move_user(app.config, user_id, shard))
+    except LookupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Moved {moved} budgets of user {user_id} to {shard}.")
+
+@app.cli.command('shard-report')
+def shard_report_command():
+    """Users, budgets, transactions and spending per shard, gathered in parallel."""
+    for name, row in shards.shard_report(app.config).items():
+        click.echo(f"{name:>12}  {row['Users']:>8} users  {row['Budgets']:>9} budgets  "
+                   f"{row['Transactions']:>11} transactions  {row['Spent']:>14.2f} spent  "
+                   f"{row['Bytes'] / 2**20:>9.1f} MiB")
+
+@app.cli.command('generate-reports')
+@click.option('--month', type=click.DateTime(['%Y-%m']), default=None,
+              help='Month to report on, YYYY-MM (default: last month).')
+@click.option('--out', 'out_folder', default=None, help='Folder to write to (default: REPORTS_FOLDER).')
+@click.option('--workers', type=int, default=None,
+              help='Rendering processes; 0 renders inline (default: REPORT_WORKERS).')
+def generate_reports_command(month, out_folder, workers):
+    """Render the printable report of every budget of a month, e.g. at month close."""
+    if month:
+        year, month = month.year, month.month
+    else:
+        today = date.today()
+        year, month = months_back(today.year, today.month, 2)
+    out_folder = out_folder or app.config['REPORTS_FOLDER']
+    workers = app.config['REPORT_WORKERS'] if workers is None else workers
+    rendered = reports.generate_reports(app.config, year, month, out_folder, workers)
+    click.echo(f"Rendered {rendered} reports for {year}-{month:02d} into {out_folder}.")
+
+@app.cli.command('vendor-assets')
+def vendor_assets_command():
+    """Download the pinned third-party libraries missing from static/vendor."""
+    fetched = assets.fetch_vendor(app.static_folder)
+    click.echo(f"Fetched {len(fetched)} files." if fetched else "All vendored files present.")
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fetch missing vendored files, then bundle, fingerprint and precompress into ASSETS_FOLDER."""
+    try:
+        fetched = assets.fetch_vendor(app.static_folder)
+    except OSError as e:
+        raise click.ClickException(f"Fetching the vendored files failed ({e}); pages keep "
+                                   f"linking their CDN copies until a build succeeds.")
+    for name in fetched:
+        click.echo(f"fetched {name}")
+    manifest = assets.build_assets(app.static_folder, app.config['ASSETS_FOLDER'])
+    for bundle, built in sorted(manifest.items()):
+        click.echo(f"{bundle} -> {built}")
 
 @app.route('/')
 def home():
@@ -75,21 +448,29 @@ def signup():
             flash("Password must be at least 6 characters long.", "error")
             return redirect(url_for('signup'))
 
-        hashed_password = generate_password_hash(password)
+        try:
+            hashed_password = password_hasher.hash(password)
+        except auth.HasherBusy:
+            flash("The server is busy, please try again in a moment.", "error")
+            return redirect(url_for('signup'))
 
         try:
-            db = get_db()
+            db = get_directory()
             cursor = db.cursor()
-            cursor.execute("SELECT * FROM User WHERE Username = ? OR Email = ?", (username, email))
+            cursor.execute("SELECT 1 FROM User WHERE Username = ? OR Email = ?", (username, email))
             if cursor.fetchone():
                 flash("Username or email already exists!", "error")
                 return redirect(url_for('signup'))
 
-            cursor.execute("""
-                INSERT INTO User (FirstName, LastName, AccountType, Username, Email, Password)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (first_name, last_name, account_type, username, email, hashed_password))
-            db.commit()
+            with transaction(db):
+                cursor.execute("""
+                    INSERT INTO User (FirstName, LastName, AccountType, Username, Email, Password)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (first_name, last_name, account_type, username, email, hashed_password))
+                shard = shards.place(app.config, cursor.lastrowid)
+                if shard is not None:
+                    cursor.execute("UPDATE User SET Shard = ? WHERE UserID = ?",
+                                   (shard, cursor.lastrowid))
             flash("Account created successfully! Please login.", "success")
             return redirect(url_for('login'))
         except sqlite3.Error as e:
@@ -104,186 +485,206 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        db = get_db()
+        # 1. Refuse usernames that have used up their failed attempts, before hashing
+        if not login_limiter.allowed(username):
+            flash("Too many failed attempts. Please try again later.", "error")
+            return redirect(url_for('login'))
+
+        db = get_directory()
         cursor = db.cursor()
-        cursor.execute("SELECT * FROM User WHERE Username = ?", (username,))
+        cursor.execute(f"SELECT {USER_COLUMNS}, Password FROM User WHERE Username = ?", (username,))
         user_row = cursor.fetchone()
-        
-        if user_row and check_password_hash(user_row['Password'], password):
-            user = User(user_row)  # Create a User instance
-            login_user(user)  # Log the user in
-            flash("Login successful!", "success")
-            return redirect(url_for('dashboard'))
-        
-        flash("Invalid credentials.", "error")
-        return redirect(url_for('login'))
-    
+
+        # 2. Verify in the hashing pool; unknown usernames cost the same time
+        try:
+            if user_row:
+                valid = password_hasher.verify(user_row['Password'], password)
+            else:
+                valid = password_hasher.verify_missing(password)
+        except auth.HasherBusy:
+            flash("The server is busy, please try again in a moment.", "error")
+            return redirect(url_for('login'))
+
+        if not valid:
+            login_limiter.record_failure(username)
+            flash("Invalid credentials.", "error")
+            return redirect(url_for('login'))
+
+        # 3. Upgrade hashes made under an older method or cost while we have the password
+        login_limiter.reset(username)
+        user = User(user_row)  # Create a User instance
+        if password_hasher.needs_rehash(user_row['Password']):
+            try:
+                rehashed = password_hasher.hash(password)
+                with transaction(db):
+                    db.execute("UPDATE User SET Password = ? WHERE UserID = ?",
+                               (rehashed, user.id))
+            except (auth.HasherBusy, sqlite3.Error) as e:
+                app.logger.warning("Password rehash for user %s failed: %s", user.id, e)
+
+        login_user(user)  # Log the user in
+        user_cache.set(user.get_id(), user)
+        flash("Login successful!", "success")
+        return redirect(url_for('dashboard'))
+
     return render_template('login.html')
 
 
 @app.route('/dashboard')
 @login_required
 def dashboard():
+    # The page is a shell; its data comes from /api/v1/dashboard
+    return render_template('dashboard.html',
+                           first_name=current_user.first_name.capitalize(),
+                           last_name=current_user.last_name.capitalize())
+
+
+@app.route('/api/v1/dashboard')
+@login_required
+async def dashboard_api():
+    return jsonify(await run_query(load_dashboard, current_user.id))
+
+
+@app.route('/api/v1/history')
+@login_required
+@cached_page(history_cache_key, 'application/json')
+async def history_api():
+    return app.json.dumps({'budgets': await run_query(load_history, current_user.id)})
+
+
+@app.route('/api/v1/budgets/<int:budget_id>/charts')
+@login_required
+@cached_page(charts_cache_key, 'application/json')
+async def budget_charts_api(budget_id):
+    charts = await run_query(load_budget_charts, current_user.id, budget_id)
+    if charts is None:
+        abort(404)
+    return app.json.dumps(charts)
+
+
+@app.route('/search')
+@login_required
+def search():
+    # The page is a shell; results come from /api/v1/search
+    return render_template('search.html', query=request.args.get('q', ''))
+
+
+def iso_date(value):
+    """Normalise a YYYY-MM-DD query argument; raises ValueError otherwise."""
+    return date.fromisoformat(value).isoformat()
+
+
+@app.route('/api/v1/search')
+@login_required
+async def search_api():
+    args = request.args
+    try:
+        date_from = iso_date(args['from']) if args.get('from') else None
+        date_to = iso_date(args['to']) if args.get('to') else None
+        min_amount = float(args['min']) if args.get('min') else None
+        max_amount = float(args['max']) if args.get('max') else None
+    except ValueError:
+        abort(400)
+    return jsonify(await run_query(
+        search_transactions, current_user.id, args.get('q', ''), date_from, date_to,
+        min_amount, max_amount, args.get('category'), args.get('page', 1, type=int)))
+
+
+@app.route('/api/budgets/<int:budget_id>/transactions')
+@login_required
+def budget_transactions_api(budget_id):
     db = get_db()
-    cursor = db.cursor()
+    budget = db.execute("""
+        SELECT EXISTS (SELECT 1 FROM ArchivedBudget a WHERE a.BudgetID = b.BudgetID) AS Archived
+        FROM Budget b WHERE b.BudgetID = ? AND b.UserID = ?
+    """, (budget_id, current_user.id)).fetchone()
+    if not budget:
+        abort(404)
 
-    # Get latest budget for user
-    cursor.execute("""
-        SELECT BudgetID, AccountLimit, Month, Year
-        FROM Budget WHERE UserID = ?
-        ORDER BY Year DESC, Month DESC LIMIT 1
-    """, (current_user.id,))  # ✅ use current_user.id
-    latest_budget = cursor.fetchone()
-
-    expenses = []
-    categories = []
-    transactions = []
-    reward_total = 0
-    category_totals = []
-
-    if latest_budget:
-        month = latest_budget['Month']
-        month_name = calendar.month_name[int(month)] if month else "N/A"
-        latest_budget = dict(latest_budget)
-        latest_budget['MonthName'] = month_name
-
-        # Get transactions
-        cursor.execute("""
-            SELECT Amount, Date, Category, Description
-            FROM "Transaction"
-            WHERE BudgetID = ?
-            ORDER BY Date DESC
-        """, (latest_budget['BudgetID'],))
-        transactions = cursor.fetchall()
-
-        total_transactions = sum([row['Amount'] for row in transactions])
-        latest_budget['TotalTransactions'] = total_transactions
-
-        # Reward logic
-        current_date = datetime.today()
-        budget_year = int(latest_budget['Year'])
-        budget_month = int(latest_budget['Month'])
-
-        if budget_year < current_date.year or (budget_year == current_date.year and budget_month < current_date.month):
-            cursor.execute("""
-                SELECT 1 FROM Rewards
-                WHERE RewardID = ? AND UserID = ?
-            """, (latest_budget['BudgetID'], current_user.id))
-            reward_exists = cursor.fetchone()
-
-            if not reward_exists:
-                reward_amount = 0.10
-                if total_transactions <= float(latest_budget['AccountLimit']):
-                    unused = float(latest_budget['AccountLimit']) - total_transactions
-                    reward_amount += round(unused * 0.05, 2)
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), 100))
+    try:
+        rows, next_cursor = transactions_page(db, budget_id, request.args.get('after'), limit,
+                                              archived=budget['Archived'])
+    except ValueError:
+        abort(400)
 
-                cursor.execute("""
-                    INSERT INTO Rewards (RewardID, UserID, Amount)
-                    VALUES (?, ?, ?)
-                """, (latest_budget['BudgetID'], current_user.id, reward_amount))
-                db.commit()
-
-        # Expenses and category totals
-        cursor.execute("""
-            SELECT Amount, Category FROM Expense WHERE BudgetID = ?
-        """, (latest_budget['BudgetID'],))
-        expenses = cursor.fetchall()
-
-        cursor.execute("""
-            SELECT DISTINCT Category FROM Expense WHERE BudgetID = ?
-        """, (latest_budget['BudgetID'],))
-        categories = [row['Category'].capitalize() for row in cursor.fetchall()]
-
-        cursor.execute("""
-            SELECT Category, SUM(Amount) AS TotalAmount
-            FROM Expense
-            WHERE BudgetID = ?
-            GROUP BY Category
-        """, (latest_budget['BudgetID'],))
-        category_totals = cursor.fetchall()
-
-    # Total rewards
-    cursor.execute("""
-        SELECT COALESCE(SUM(Amount), 0) AS total FROM Rewards
-        WHERE UserID = ?
-    """, (current_user.id,))
-    reward_row = cursor.fetchone()
-    reward_total = reward_row['total'] if reward_row else 0
+    return jsonify(transactions=[dict(row) for row in rows], next=next_cursor)
 
-    return render_template('dashboard.html',
-                           first_name=current_user.first_name.capitalize(),
-                           last_name=current_user.last_name.capitalize(),
-                           latest_budget=latest_budget,
-                           expenses=expenses,
-                           categories=categories,
-                           transactions=transactions,
-                           reward_total=reward_total,
-                           category_totals=category_totals)
 
+@app.route('/api/analytics')
+@login_required
+def analytics_api():
+    today = date.today()
+    months = max(1, min(request.args.get('months', 12, type=int), 120))
+    year = request.args.get('year', today.year, type=int)
+    category = request.args.get('category') or None
+    end = (today.year, today.month)
+    start = months_back(*end, months)
 
+    db = get_db()
+    return jsonify(
+        period={'start': f"{start[0]}-{start[1]:02d}", 'end': f"{end[0]}-{end[1]:02d}"},
+        trend=monthly_trend(db, current_user.id, start, end, category),
+        year_over_year=year_over_year(db, current_user.id, year, category),
+        categories=category_breakdown(db, current_user.id, start, end),
+    )
 
 
 @app.route('/logout')
 @login_required
 def logout():
+    invalidate_user(current_user.id)
     logout_user()
     flash("You have been logged out.", "info")
     return redirect(url_for('login'))
 
 
 @app.route('/create_budget', methods=['GET', 'POST'])
+@login_required
 def create_budget():
     if request.method == 'POST':
-        account_limit = request.form['account_limit']
-        month = request.form['month']
-        year = request.form['year']
-        income = request.form['income']
-        total_expenses = int(request.form['total_expenses'])
-
-        if not account_limit or not month or not year or not income:
+        form = request.form
+        if not all(form.get(field) for field in ('account_limit', 'month', 'year', 'income')):
             flash("All fields are required.", "error")
             return redirect(url_for('create_budget'))
-
         try:
-            db = get_db()
-            cursor = db.cursor()
-            cursor.execute("""
-                INSERT INTO Budget (UserID, AccountLimit, Month, Year, Income)
-                VALUES (?, ?, ?, ?, ?)
-            """, (current_user.id, account_limit, month, year, income))
-            db.commit()
-            budget_id = cursor.lastrowid
-
-            for i in range(1, total_expenses + 1):
-                category = request.form.get(f'Category{i}')
-                amount_str = request.form.get(f'expense_amount_{i}')
-                if category and amount_str and amount_str.strip():
-                    try:
-                        amount = float(amount_str)
-                        cursor.execute("""
-                            INSERT INTO Expense (BudgetID, Category, Amount)
-                            VALUES (?, ?, ?)
-                        """, (budget_id, category, amount))
-                    except ValueError:
-                        flash(f"Invalid amount for category '{category}'. Please enter a valid number.", "error")
-                        db.rollback()
-                        return redirect(url_for('create_budget'))
-
-            db.commit()
-            db.close()
+            account_limit = float(form['account_limit'])
+            income = float(form['income'])
+            month = int(form['month'])
+            year = int(form['year'])
+            total_expenses = int(form.get('total_expenses') or 0)
+        except ValueError:
+            flash("Please enter valid numbers for the budget.", "error")
+            return redirect(url_for('create_budget'))
 
-            flash("Budget and expenses created successfully!", "success")
-            return redirect(url_for('dashboard'))
+        # 1. Validate every expense row before writing anything
+        expenses, errors = budgets.parse_expense_rows(form, total_expenses)
+        if errors:
+            for message in errors:
+                flash(message, "error")
+            return redirect(url_for('create_budget'))
 
+        # 2. Insert the budget and all its expenses in one transaction
+        try:
+            _, copied = budgets.create_budget(get_db(), current_user.id, account_limit, month,
+                                              year, income, expenses,
+                                              clone_previous=bool(form.get('clone_previous')))
         except sqlite3.Error as e:
-            db.rollback()
-            db.close()
             flash(f"Error creating budget: {e}", "error")
             return redirect(url_for('create_budget'))
 
+        invalidate_pages(current_user.id)
+        if copied:
+            flash(f"Budget created with {copied} categories copied from your previous budget.",
+                  "success")
+        else:
+            flash("Budget and expenses created successfully!", "success")
+        return redirect(url_for('dashboard'))
+
     return render_template('create_budget.html')
 
 @app.route('/add_expense', methods=['POST'])
+@login_required
 def add_expense():
     category = request.form['Category']
     other_category = request.form.get('OtherCategory')
@@ -294,51 +695,24 @@ def add_expense():
     if category == 'Other' and other_category:
         category = other_category
 
+    # Check and insert in one transaction, so concurrent requests can't overspend
     try:
-        db = get_db()
-        cursor = db.cursor()
-
-        # 1. Get current total of expenses for this budget
-        cursor.execute("""
-            SELECT SUM(Amount) as Total FROM Expense
-            WHERE BudgetID = ?
-        """, (budget_id,))
-        result = cursor.fetchone()
-        current_expenses = result['Total'] if result and result['Total'] else 0
-
-        # 2. Get the budget limit
-        cursor.execute("SELECT AccountLimit FROM Budget WHERE BudgetID = ?", (budget_id,))
-        budget = cursor.fetchone()
-        if not budget:
-            flash("Budget not found.", "error")
-            return redirect(url_for('dashboard'))
-
-        account_limit = float(budget['AccountLimit'])
-
-        # 3. Check if adding this expense would exceed the budget
-        if current_expenses + amount > account_limit:
-            flash("⚠️ This expense would exceed your overall account limit!", "warning")
-            return redirect(url_for('dashboard'))
-
-        # 4. Insert the expense
-        cursor.execute("""
-            INSERT INTO Expense (BudgetID, Category, Amount)
-            VALUES (?, ?, ?)
-        """, (budget_id, category, amount))
-        db.commit()
-
-        flash("Expense added successfully!", "success")
-
+        limits.add_expense(get_db(), current_user.id, budget_id, category, amount)
+    except LookupError:
+        abort(404)
+    except limits.LimitExceeded as e:
+        flash(f"⚠️ {e}", "warning")
     except sqlite3.Error as e:
-        db.rollback()
         flash(f"Error adding expense: {e}", "error")
-    finally:
-        db.close()
-    
+    else:
+        invalidate_pages(current_user.id, budget_id)
+        flash("Expense added successfully!", "success")
+
     return redirect(url_for('dashboard'))
 
 
 @app.route('/add_transaction', methods=['POST'])
+@login_required
 def add_transaction():
     description = request.form['transaction_description']
     category = request.form['Category']
@@ -346,153 +720,105 @@ def add_transaction():
     date = request.form['transaction_date']
     budget_id = request.form['budget_id']
 
+    # Check both limits and insert in one transaction, so concurrent requests can't overspend
     try:
-        db = get_db()
-        cursor = db.cursor()
+        limits.add_transaction(get_db(), current_user.id, budget_id, description, category,
+                               amount, date)
+    except LookupError:
+        abort(404)
+    except limits.LimitExceeded as e:
+        flash(f"⚠️ {e}", "warning")
+    except sqlite3.Error as e:
+        flash(f"Error adding transaction: {e}", "error")
+    else:
+        invalidate_pages(current_user.id, budget_id)
+        flash("Transaction added successfully!", "success")
 
-        # 1. Get budget info
-        cursor.execute("SELECT AccountLimit FROM Budget WHERE BudgetID = ?", (budget_id,))
-        budget = cursor.fetchone()
-        if not budget:
-            flash("Budget not found.", "error")
-            return redirect(url_for('dashboard'))
-
-        account_limit = float(budget['AccountLimit'])
-
-        # 2. Get total transactions so far
-        cursor.execute("""
-            SELECT SUM(Amount) as Total FROM "Transaction"
-            WHERE BudgetID = ?
-        """, (budget_id,))
-        result = cursor.fetchone()
-        current_total = result['Total'] if result and result['Total'] else 0
-
-        # Check if new transaction would exceed total budget
-        if current_total + amount > account_limit:
-            flash("⚠️ This transaction would exceed your overall account limit!", "warning")
-            return redirect(url_for('dashboard'))  # 🚫 STOP
-
-        # 3. Check category limit
-        cursor.execute("""
-            SELECT SUM(Amount) as Total FROM "Transaction"
-            WHERE BudgetID = ? AND Category = ?
-        """, (budget_id, category))
-        result = cursor.fetchone()
-        category_total = result['Total'] if result and result['Total'] else 0
-
-        cursor.execute("""
-            SELECT Amount FROM Expense
-            WHERE BudgetID = ? AND Category = ?
-        """, (budget_id, category))
-        expense = cursor.fetchone()
-        if expense:
-            category_limit = float(expense['Amount'])
-            if category_total + amount > category_limit:
-                flash(f"⚠️ This transaction would exceed your budget for the '{category}' category!", "warning")
-                return redirect(url_for('dashboard'))  # 🚫 STOP
-        else:
-            flash(f"⚠️ No defined expense for '{category}'.", "warning")
-            return redirect(url_for('dashboard'))  # 🚫 STOP
-
-        # 4. Insert transaction
-        cursor.execute("""
-            INSERT INTO "Transaction" (Description, Category, Amount, Date, BudgetID)
-            VALUES (?, ?, ?, ?, ?)
-        """, (description, category, amount, date, budget_id))
-        db.commit()
-
-        # 5. Update total transactions in Budget table and shows result
-        cursor.execute("""
-            SELECT SUM(Amount) as Total FROM "Transaction"
-            WHERE BudgetID = ?
-        """, (budget_id,))
-        total_result = cursor.fetchone()
-        total_transactions = total_result['Total'] if total_result and total_result['Total'] else 0
-
-        cursor.execute("""
-            UPDATE Budget SET TotalTransactions = ?
-            WHERE BudgetID = ?
-        """, (total_transactions, budget_id))
-        db.commit()
+    return redirect(url_for('dashboard'))
 
-        flash("Transaction added successfully!", "success")
-        return redirect(url_for('dashboard'))
 
-    except sqlite3.Error as e:
-        db.rollback()
-        flash(f"Error adding transaction: {e}", "error")
-        return redirect(url_for('dashboard'))
-    
-@app.route('/history')
+@app.route('/import', methods=['GET', 'POST'])
 @login_required
-def history():
+def import_statement():
     db = get_db()
-    cursor = db.cursor()
-
-    cursor.execute("""
-        SELECT               -- ← added BudgetID
-            b.BudgetID,
-            b.Month,
-            b.Year,
-            b.AccountLimit,
-            COALESCE(SUM(t.Amount), 0) AS TotalTransactions
-        FROM Budget b
-        LEFT JOIN "Transaction" t ON b.BudgetID = t.BudgetID
-        WHERE b.UserID = ?
-        GROUP BY b.BudgetID
-        ORDER BY b.Year DESC, b.Month DESC
-    """, (current_user.id,))
-
-    budget_rows = cursor.fetchall()
-
-    budget_history = []
-    for row in budget_rows:
+    user_budgets = []
+    for row in db.execute("""
+        SELECT BudgetID, Month, Year FROM Budget
+        WHERE UserID = ?
+        ORDER BY Year DESC, Month DESC
+    """, (current_user.id,)):
         row = dict(row)
         row['MonthName'] = calendar.month_name[int(row['Month'])] if row['Month'] else "Unknown"
-        budget_history.append(row)
+        user_budgets.append(row)
+
+    result = None
+    if request.method == 'POST':
+        budget_id = request.form.get('budget_id', type=int)
+        upload = request.files.get('statement')
+        if budget_id not in {budget['BudgetID'] for budget in user_budgets}:
+            flash("Budget not found.", "error")
+            return redirect(url_for('import_statement'))
+        if not upload or not upload.filename:
+            flash("Please choose a statement file.", "error")
+            return redirect(url_for('import_statement'))
+
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        if upload.filename.lower().endswith(('.ofx', '.qfx')):
+            rows = parse_ofx(stream, request.form.get('category', '').strip())
+        else:
+            rows = parse_csv(stream)
+        try:
+            result = import_transactions(db, budget_id, rows)
+        except (UnicodeDecodeError, sqlite3.Error) as e:
+            flash(f"Error importing statement: {e}", "error")
+            return redirect(url_for('import_statement'))
+        finally:
+            invalidate_pages(current_user.id, budget_id)
+
+        flash(f"Imported {result.imported} transactions, rejected {len(result.rejected)}.",
+              "success" if not result.rejected else "warning")
+
+    return render_template('import.html', budgets=user_budgets, result=result)
+
 
-    return render_template("history.html", budget_history=budget_history)
+@app.route('/history')
+@login_required
+def history():
+    return render_template("history.html")
 
 
 @app.route('/history/<int:budget_id>')
 @login_required
 def view_budget_charts(budget_id):
-    db = get_db()
-    cursor = db.cursor()
+    return render_template('budget_charts.html', budget_id=budget_id)
 
-    # Get budget info
-    cursor.execute("""
-        SELECT * FROM Budget
-        WHERE BudgetID = ? AND UserID = ?
-    """, (budget_id, current_user.id))  # ✅ use current_user.id
 
-    budget = cursor.fetchone()
-    if not budget:
-        flash("Budget not found.", "error")
-        return redirect(url_for('history'))
-
-    budget = dict(budget)
-    budget['MonthName'] = calendar.month_name[int(budget['Month'])]
-
-    # Get expenses for pie chart
-    cursor.execute("""
-        SELECT Category, Amount FROM Expense WHERE BudgetID = ?
-    """, (budget_id,))
-    expenses = cursor.fetchall()
-
-    # Get transactions for bar chart
-    cursor.execute("""
-        SELECT Category, SUM(Amount) AS Total
-        FROM "Transaction"
-        WHERE BudgetID = ?
-        GROUP BY Category
-    """, (budget_id,))
-    transactions = cursor.fetchall()
-
-    return render_template('budget_charts.html',
-                           budget=budget,
-                           expenses=expenses,
-                           transactions=transactions)
+@app.route('/history/<int:budget_id>/report')
+@login_required
+def budget_report(budget_id):
+    html = reports.render_report(get_db(), current_user.id, budget_id)
+    if html is None:
+        abort(404)
+    return html
+
+
+@app.route('/export/<int:budget_id>')
+@app.route('/export/all', defaults={'budget_id': None})
+@login_required
+def export_transactions(budget_id):
+    """Download transactions as ?format=csv (default), jsonl or xlsx, streamed as they're read."""
+    file_format = request.args.get('format', 'csv')
+    if file_format not in exports.FORMATS:
+        abort(400)
+    db = get_db()
+    export_budgets = exports.user_budgets(db, current_user.id, budget_id)
+    if budget_id is not None and not export_budgets:
+        abort(404)
+    mimetype, ext = exports.FORMATS[file_format]
+    filename = f"budget-{budget_id}.{ext}" if budget_id is not None else f"transactions.{ext}"
+    return Response(stream_with_context(exports.stream_export(db, export_budgets, file_format)),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 if __name__ == '__main__':
     app.run(debug=True)
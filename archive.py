@@ -0,0 +1,90 @@
+# archive.py
+"""Archival of old transactions into a cold-store SQLite database.
+
+The archive is a separate file attached to every connection as schema
+`archive` (see db.attach_archive). Its single "Transaction" table is a
+WITHOUT ROWID table clustered on (BudgetID, Date, TransactionID), so an
+archived budget's transactions sit together on disk with no extra index.
+Summaries never leave the hot database: BudgetTotals, CategoryTotals and
+MonthlyRollup keep covering archived budgets, so history, charts and
+analytics read exactly what they did before.
+
+archive_budgets() works a batch of budgets at a time, in two transactions
+per batch:
+
+1. copy the budgets' transactions into the archive (INSERT OR IGNORE, so a
+   rerun after a crash is harmless) and add them to the archive's search
+   index;
+2. mark the budgets in ArchivedBudget and delete the hot rows. For the
+   delete the budgets are also listed in ArchiveMove, which stops the delete
+   triggers from touching the totals; it's emptied before the commit, so a
+   row added to an archived budget later and deleted is counted as usual.
+
+A crash between the two steps leaves rows in both stores; AllTransactions
+counts them once and the next run finishes the move. Schedule it monthly,
+e.g. from cron:
+
+    0 3 1 * *  cd /srv/smartex && flask archive-transactions --vacuum
+"""
+from db import TRANSACTION_COLUMNS, transaction
+
+BATCH_SIZE = 100
+
+# Budgets older than the horizon with transactions still in the hot table
+CANDIDATES = """
+    SELECT b.BudgetID
+    FROM Budget b
+    WHERE (b.Year, CAST(b.Month AS INTEGER)) < (:year, :month)
+      AND EXISTS (SELECT 1 FROM main."Transaction" t WHERE t.BudgetID = b.BudgetID)
+    ORDER BY b.BudgetID
+"""
+
+
+def is_attached(db):
+    return any(row[1] == 'archive' for row in db.execute("PRAGMA database_list"))
+
+
+def index_archived(db, budget_ids):
+    """Add the budgets' archived transactions to archive.TransactionSearch, once each."""
+    placeholders = ', '.join('?' * len(budget_ids))
+    db.execute(f"""
+        INSERT INTO archive.TransactionSearch (rowid, Description, Category, BudgetID)
+        SELECT a.TransactionID, IFNULL(a.Description, ''), IFNULL(a.Category, ''), a.BudgetID
+        FROM archive."Transaction" a
+        WHERE a.BudgetID IN ({placeholders})
+          AND NOT EXISTS (SELECT 1 FROM archive.TransactionSearch s
+                          WHERE s.rowid = a.TransactionID)
+    """, budget_ids)
+
+
+def archive_budgets(db, before, batch_size=BATCH_SIZE):
+    """Move the transactions of budgets older than `before` (year, month) to the archive.
+
+    Returns (budgets archived, transactions moved).
+    """
+    if not is_attached(db):
+        raise RuntimeError("no archive database attached; set ARCHIVE_DATABASE")
+
+    budget_ids = [row[0] for row in db.execute(
+        CANDIDATES, {'year': before[0], 'month': before[1]})]
+    moved = 0
+    for start in range(0, len(budget_ids), batch_size):
+        batch = budget_ids[start:start + batch_size]
+        placeholders = ', '.join('?' * len(batch))
+        with transaction(db):
+            db.execute(f"""
+                INSERT OR IGNORE INTO archive."Transaction" ({TRANSACTION_COLUMNS})
+                SELECT {TRANSACTION_COLUMNS} FROM main."Transaction"
+                WHERE BudgetID IN ({placeholders})
+            """, batch)
+            index_archived(db, batch)
+        with transaction(db):
+            db.executemany("INSERT OR IGNORE INTO ArchivedBudget (BudgetID) VALUES (?)",
+                           [(budget_id,) for budget_id in batch])
+            db.executemany("INSERT INTO ArchiveMove (BudgetID) VALUES (?)",
+                           [(budget_id,) for budget_id in batch])
+            moved += db.execute(f"""
+                DELETE FROM main."Transaction" WHERE BudgetID IN ({placeholders})
+            """, batch).rowcount
+            db.execute("DELETE FROM ArchiveMove")
+    return len(budget_ids), moved
@@ -0,0 +1,285 @@
+# assets.py
+"""Vendored, bundled and fingerprinted static assets.
+
+The third-party libraries the pages use are pinned in VENDOR and kept under
+static/vendor/, so a built site loads nothing from a CDN. `flask build-assets`
+first downloads any that are missing (fetch_vendor; it fails if a download
+does) and then writes BUNDLES into ASSETS_FOLDER (static/dist by default):
+
+1. each bundle's sources are concatenated, our own CSS minified (the vendored
+   files ship minified already), and local images and fonts the CSS refers
+   to are copied in under their own content hash;
+2. the output is named after its content hash, e.g. site.3fa2c1b0d9e4.css,
+   with .gz and, when the brotli package is installed, .br next to it;
+3. manifest.json maps each bundle to its current file.
+
+Because a changed file gets a new name, /assets/ responses are served with
+`Cache-Control: immutable` and a one-year max-age. Old builds are left in
+place so pages still cached by browsers keep working; delete the folder to
+prune them.
+
+Backgrounds listed in RESPONSIVE_BACKGROUNDS are also resized to each width
+(Pillow is optional; without it the original is used at every size) and
+media queries pick the smallest one that covers the viewport.
+
+Until a build exists, templates link the sources one by one from static/,
+and a vendored file that hasn't been fetched yet from its VENDOR URL, so a
+fresh checkout renders before its first build. build_assets() refuses to
+build without every vendored file.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import urllib.request
+
+from flask import send_from_directory
+
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+JPEG_QUALITY = 80
+# Images are compressed already; gzip/brotli only pay off for text
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.ttf')
+
+# static/vendor/<name>: where `flask vendor-assets` downloads it from
+VENDOR = {
+    'vendor/bootstrap-4.5.2.min.css':
+        'https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/css/bootstrap.min.css',
+    'vendor/bootstrap-4.5.2.min.js':
+        'https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.min.js',
+    'vendor/bootstrap-5.3.3.min.css':
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css',
+    'vendor/bootstrap-5.3.3.bundle.min.js':
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js',
+    'vendor/jquery-3.6.0.min.js': 'https://code.jquery.com/jquery-3.6.0.min.js',
+    'vendor/popper-2.5.0.min.js':
+        'https://cdn.jsdelivr.net/npm/@popperjs/core@2.5.0/dist/umd/popper.min.js',
+    'vendor/chart-4.4.0.umd.min.js':
+        'https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js',
+    # Only the solid icons are used; their CSS points at ../webfonts/
+    'vendor/fontawesome-6.4.0/css/fontawesome.min.css':
+        'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/fontawesome.min.css',
+    'vendor/fontawesome-6.4.0/css/solid.min.css':
+        'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/solid.min.css',
+    'vendor/fontawesome-6.4.0/webfonts/fa-solid-900.woff2':
+        'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-solid-900.woff2',
+    'vendor/fontawesome-6.4.0/webfonts/fa-solid-900.ttf':
+        'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-solid-900.ttf',
+    # Latin subset of the weights fonts.css declares
+    'vendor/poppins-5.0.8/poppins-latin-400-normal.woff2':
+        'https://cdn.jsdelivr.net/npm/@fontsource/poppins@5.0.8/files/poppins-latin-400-normal.woff2',
+    'vendor/poppins-5.0.8/poppins-latin-600-normal.woff2':
+        'https://cdn.jsdelivr.net/npm/@fontsource/poppins@5.0.8/files/poppins-latin-600-normal.woff2',
+}
+
+# Bundle name: sources under static/, in page order
+BUNDLES = {
+    'site.css': ['fonts.css', 'styles.css'],
+    'icons.css': ['vendor/fontawesome-6.4.0/css/fontawesome.min.css',
+                  'vendor/fontawesome-6.4.0/css/solid.min.css'],
+    'bootstrap4.css': ['fonts.css', 'styles.css', 'vendor/bootstrap-4.5.2.min.css'],
+    'bootstrap4.js': ['vendor/jquery-3.6.0.min.js', 'vendor/popper-2.5.0.min.js',
+                      'vendor/bootstrap-4.5.2.min.js'],
+    'bootstrap5.css': ['fonts.css', 'styles.css', 'vendor/bootstrap-5.3.3.min.css'],
+    'charts.css': ['vendor/bootstrap-5.3.3.min.css'],
+    'bootstrap5.js': ['vendor/bootstrap-5.3.3.bundle.min.js'],
+    'charts.js': ['vendor/chart-4.4.0.umd.min.js'],
+}
+
+# (CSS selector, image under static/, widths to resize to)
+RESPONSIVE_BACKGROUNDS = [
+    ('body', 'images/background.jpeg', (640, 1280, 1920)),
+]
+
+STATIC_URL = re.compile(r"""url\(\s*['"]?/static/([^'")]+?)['"]?\s*\)""")
+# url(../webfonts/x.woff2) and the like in vendored CSS; not absolute, data: or remote
+RELATIVE_URL = re.compile(r"""url\(\s*['"]?(?![a-z]+:|/|#)([^'")?#]+)[^'")]*['"]?\s*\)""")
+
+_manifests = {}
+
+
+def fingerprint(name, data):
+    """`name` with the content hash of `data` before its extension."""
+    stem, ext = os.path.splitext(os.path.basename(name))
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def minify_css(text):
+    """Drop comments (but not /*! licences */) and the whitespace that doesn't matter."""
+    text = re.sub(r'/\*(?!!).*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};>])\s*', r'\1', text)
+    text = re.sub(r'([:,])\s', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def missing_vendor(static_folder):
+    return [name for name in VENDOR if not os.path.isfile(os.path.join(static_folder, name))]
+
+
+def fetch_vendor(static_folder):
+    """Download the vendored libraries that aren't in static/ yet; returns their names."""
+    fetched = []
+    for name in missing_vendor(static_folder):
+        path = os.path.join(static_folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(VENDOR[name], timeout=30) as response:
+            data = response.read()
+        with open(path + '.part', 'wb') as out:
+            out.write(data)
+        os.replace(path + '.part', path)
+        fetched.append(name)
+    return fetched
+
+
+def _write(out_folder, name, data):
+    """Write `data` and its precompressed variants; returns the fingerprinted name."""
+    built = fingerprint(name, data)
+    path = os.path.join(out_folder, built)
+    if os.path.exists(path):
+        return built
+    variants = [('', data)]
+    if built.endswith(COMPRESSIBLE):
+        variants.append(('.gz', gzip.compress(data, 9, mtime=0)))
+        try:
+            import brotli  # optional: without it only gzip variants are written
+            variants.append(('.br', brotli.compress(data)))
+        except ImportError:
+            pass
+    # The uncompressed file goes last, so its presence means the set is complete
+    for suffix, content in sorted(variants, key=lambda v: v[0] == ''):
+        if suffix and len(content) >= len(data):
+            continue
+        with open(path + suffix + '.part', 'wb') as out:
+            out.write(content)
+        os.replace(path + suffix + '.part', path + suffix)
+    return built
+
+
+def _resized(path, widths):
+    """JPEG bytes of the image at each width below its own, or {} without Pillow."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return {}
+    sizes = {}
+    with Image.open(path) as image:
+        image = image.convert('RGB')
+        for width in widths:
+            if width >= image.width:
+                continue
+            height = round(image.height * width / image.width)
+            buffer = io.BytesIO()
+            image.resize((width, height), Image.LANCZOS).save(
+                buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            sizes[width] = buffer.getvalue()
+    return sizes
+
+
+def _static_file(static_folder, out_folder, name, built):
+    """Copy a file the CSS refers to into the build; returns its built name."""
+    if name not in built:
+        with open(os.path.join(static_folder, name), 'rb') as source:
+            built[name] = _write(out_folder, name, source.read())
+    return built[name]
+
+
+def _relative_to(source, url):
+    """Path under static/ of `url` as written in the static file `source`."""
+    name = posixpath.normpath(posixpath.join(posixpath.dirname(source), url))
+    if name.startswith('../'):
+        raise ValueError(f"{source} refers to {url}, outside the static folder")
+    return name
+
+
+def _background_rules(static_folder, out_folder, name, selector, widths):
+    """Media queries swapping in resized copies of the background `name`."""
+    stem, _ = os.path.splitext(name)
+    sizes = _resized(os.path.join(static_folder, name), widths)
+    # Widest first, so the narrowest matching query comes last and wins
+    return ''.join(
+        f"@media (max-width:{width}px){{{selector}{{background-image:url("
+        f"{_write(out_folder, f'{stem}-{width}.jpeg', sizes[width])})}}}}"
+        for width in sorted(sizes, reverse=True))
+
+
+def build_assets(static_folder, out_folder):
+    """Build every bundle into `out_folder`; returns the manifest ({bundle: file})."""
+    missing = missing_vendor(static_folder)
+    if missing:
+        raise FileNotFoundError(f"vendored files missing: {', '.join(missing)}")
+    os.makedirs(out_folder, exist_ok=True)
+    images = {}
+    backgrounds = {}
+    manifest = {}
+    for bundle, sources in BUNDLES.items():
+        is_css = bundle.endswith('.css')
+        parts = []
+        referenced = set()
+        for source in sources:
+            with open(os.path.join(static_folder, source), encoding='utf-8') as f:
+                text = f.read()
+            if is_css:
+                if '.min.' not in source:
+                    text = minify_css(text)
+                # Before the /static/ rewrite, whose output is relative too
+                text = RELATIVE_URL.sub(lambda m: 'url({})'.format(_static_file(
+                    static_folder, out_folder, _relative_to(source, m.group(1)), images)), text)
+                referenced.update(STATIC_URL.findall(text))
+                # Bundles are served from the same folder as the images
+                text = STATIC_URL.sub(lambda m: 'url({})'.format(
+                    _static_file(static_folder, out_folder, m.group(1), images)), text)
+            parts.append(text)
+        if is_css:
+            for selector, name, widths in RESPONSIVE_BACKGROUNDS:
+                if name in referenced:
+                    if name not in backgrounds:
+                        backgrounds[name] = _background_rules(
+                            static_folder, out_folder, name, selector, widths)
+                    parts.append(backgrounds[name])
+        content = '\n'.join(parts) if is_css else '\n;\n'.join(parts)
+        manifest[bundle] = _write(out_folder, bundle, content.encode('utf-8'))
+
+    path = os.path.join(out_folder, MANIFEST)
+    with open(path + '.part', 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+    os.replace(path + '.part', path)
+    return manifest
+
+
+def load_manifest(out_folder):
+    """The current manifest, re-read when the file changes; {} before the first build."""
+    path = os.path.join(out_folder, MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _manifests.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = _manifests[path] = (mtime, json.load(f))
+    return cached[1]
+
+
+def send_asset(out_folder, filename, accept_encodings):
+    """Serve a built file, precompressed if the client accepts it, cached for good."""
+    encoding = None
+    served = filename
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accept_encodings[candidate] and os.path.isfile(
+                os.path.join(out_folder, filename + suffix)):
+            encoding, served = candidate, filename + suffix
+            break
+    response = send_from_directory(out_folder, served, max_age=IMMUTABLE_MAX_AGE,
+                                   mimetype=mimetypes.guess_type(filename)[0])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
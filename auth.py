@@ -0,0 +1,139 @@
+# auth.py
+"""Password hashing off the request threads, and throttling of failed logins.
+
+PasswordHasher runs werkzeug's hash and check functions in a small process
+pool, so a burst of logins costs pool time instead of holding every web
+worker for the length of a key derivation. A semaphore bounds how many
+hashes can be queued or running at once; callers that can't get a slot
+within `wait` seconds get HasherBusy rather than piling up behind the pool.
+
+The method string is werkzeug's, algorithm and cost together, e.g.
+'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'. Stored hashes made with
+other parameters still verify; needs_rehash() tells the login view to
+replace them with one made under the current method.
+
+FailedLoginLimiter keeps a token bucket per username in memory: each failed
+attempt spends a token, tokens come back at a fixed rate, and an empty
+bucket refuses the attempt before any hashing is done. Like the memory page
+cache, it is per worker process.
+"""
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from cache import LRUCache
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_CONCURRENT = 8
+DEFAULT_WAIT_SECONDS = 5.0
+DEFAULT_FAILED_LOGIN_BURST = 5
+DEFAULT_FAILED_LOGIN_REFILL_SECONDS = 60
+
+
+class HasherBusy(Exception):
+    """No hashing slot became free within the wait."""
+
+
+def method_of(password_hash):
+    """The method part of a werkzeug hash ('scrypt:32768:8:1$salt$hash' -> 'scrypt:32768:8:1')."""
+    return password_hash.split('$', 1)[0]
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a bounded process pool.
+
+    With workers=0 the work runs on the calling thread (still bounded by the
+    semaphore), which is how hashing behaved before the pool existed.
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, workers=DEFAULT_WORKERS,
+                 max_concurrent=DEFAULT_MAX_CONCURRENT, wait=DEFAULT_WAIT_SECONDS):
+        self.method = method
+        self.workers = workers
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._pool = None
+        self._lock = threading.Lock()
+        self._reference = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn, not fork: the web process has threads (query pool, server)
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _call(self, function, *args):
+        if not self._slots.acquire(timeout=self.wait):
+            raise HasherBusy(f"no hashing slot free after {self.wait}s")
+        try:
+            if not self.workers:
+                return function(*args)
+            return self._executor().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._call(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._call(check_password_hash, password_hash, password)
+
+    def _reference_hash(self):
+        # Hash of an empty password under the current method: gives the canonical
+        # method string (werkzeug fills in default costs) and something to verify
+        # against for unknown usernames, so they take as long as known ones.
+        if self._reference is None:
+            self._reference = self.hash('')
+        return self._reference
+
+    def verify_missing(self, password):
+        """Spend the time of a verification for a username that doesn't exist."""
+        self.verify(self._reference_hash(), password)
+        return False
+
+    def needs_rehash(self, password_hash):
+        return method_of(password_hash) != method_of(self._reference_hash())
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+class FailedLoginLimiter:
+    """Per-username token bucket for failed logins.
+
+    A username starts with `burst` tokens; every failure spends one and one
+    comes back every `refill_seconds`. Buckets expire once they would be full
+    again, and at most `maxsize` usernames are tracked.
+    """
+
+    def __init__(self, burst=DEFAULT_FAILED_LOGIN_BURST,
+                 refill_seconds=DEFAULT_FAILED_LOGIN_REFILL_SECONDS, maxsize=100000):
+        self.burst = burst
+        self.refill_seconds = refill_seconds
+        self._buckets = LRUCache(maxsize, ttl=burst * refill_seconds)
+        self._lock = threading.Lock()
+
+    def _tokens(self, username, now):
+        tokens, updated = self._buckets.get(username, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) / self.refill_seconds)
+
+    def allowed(self, username):
+        with self._lock:
+            return self._tokens(username, time.monotonic()) >= 1
+
+    def record_failure(self, username):
+        with self._lock:
+            now = time.monotonic()
+            self._buckets.set(username, (max(0.0, self._tokens(username, now) - 1), now))
+
+    def reset(self, username):
+        self._buckets.delete(username)
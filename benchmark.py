@@ -0,0 +1,398 @@
+# benchmark.py
+"""Synthetic data generator and latency benchmark for the main routes.
+
+    python benchmark.py generate scratch.db --users 200 --budgets 12 --transactions 300
+    python benchmark.py run scratch.db --requests 500 --output results.json
+    python benchmark.py login scratch.db --logins 200 --threads 16
+    python benchmark.py limits scratch.db --writers 50 --attempts 20
+
+`generate` fills a scratch SQLite database with users, budgets, planned
+expenses and transactions. `run` drives the routes through the Flask test
+client (no network) as randomly chosen users and reports p50/p95/p99 latency
+and SQL statements per request for each scenario as JSON. `login` fires a
+burst of concurrent logins, once hashing on the request threads (as before
+the auth pool) and once per requested pool size, and reports login
+throughput alongside dashboard latency during the burst. `limits` has many
+processes add transactions to one budget at once, with and without the
+atomic limit checks, and reports the write rate of each.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from datetime import date
+
+from werkzeug.security import generate_password_hash
+
+import auth
+import db as database
+import limits
+from db import transaction
+
+CATEGORIES = ['Groceries', 'Housing', 'Car/transport', 'Pocket', 'Savings', 'Utilities',
+              'Health', 'Entertainment']
+PASSWORD = 'benchmark'
+
+
+def generate(path, users=100, budgets=12, transactions=200, categories=6, seed=0):
+    """Fill the database at `path` with synthetic data; returns the number of rows written."""
+    rng = random.Random(seed)
+    db = database.connect(path)
+    password_hash = generate_password_hash(PASSWORD)  # hashing is slow, so share one
+    today = date.today()
+    rows = 0
+    try:
+        for u in range(users):
+            with transaction(db):
+                user_id = db.execute("""
+                    INSERT INTO User (FirstName, LastName, AccountType, Username, Email, Password)
+                    VALUES (?, ?, 'personal', ?, ?, ?)
+                """, (f'first{u}', f'last{u}', f'bench{u}_{seed}', f'bench{u}_{seed}@example.com',
+                      password_hash)).lastrowid
+                for b in range(budgets):
+                    index = today.year * 12 + today.month - 1 - b
+                    year, month = index // 12, index % 12 + 1
+                    chosen = rng.sample(CATEGORIES, min(categories, len(CATEGORIES)))
+                    planned = {category: rng.randint(200, 2000) for category in chosen}
+                    budget_id = db.execute("""
+                        INSERT INTO Budget (UserID, AccountLimit, Month, Year, Income)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (user_id, sum(planned.values()), month, year,
+                          rng.randint(2000, 9000))).lastrowid
+                    db.executemany("""
+                        INSERT INTO Expense (BudgetID, Category, Amount) VALUES (?, ?, ?)
+                    """, [(budget_id, category, amount) for category, amount in planned.items()])
+                    db.executemany("""
+                        INSERT INTO "Transaction" (Description, Category, Amount, Date, BudgetID)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, [(f'purchase {t}', rng.choice(chosen), round(rng.uniform(1, 20), 2),
+                           f'{year}-{month:02d}-{rng.randint(1, 28):02d}', budget_id)
+                          for t in range(transactions)])
+                    rows += 1 + len(planned) + transactions
+                rows += 1
+    finally:
+        db.close()
+    return rows
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def _scenarios(rng, user_id, budget_ids, categories):
+    budget_id = rng.choice(budget_ids)
+    latest = budget_ids[0]
+    return {
+        'dashboard_api': ('GET', '/api/v1/dashboard', None),
+        'history_api': ('GET', '/api/v1/history', None),
+        'budget_charts_api': ('GET', f'/api/v1/budgets/{budget_id}/charts', None),
+        'search_api': ('GET', f'/api/v1/search?q=purchase+{rng.randint(1, 99)}&min=5', None),
+        'export_csv': ('GET', f'/export/{budget_id}?format=csv', None),
+        'add_transaction': ('POST', '/add_transaction', {
+            'transaction_description': 'benchmark', 'Category': rng.choice(categories),
+            'transaction_amount': '0.01', 'transaction_date': date.today().isoformat(),
+            'budget_id': latest}),
+        'add_expense': ('POST', '/add_expense', {
+            'Category': 'Other', 'OtherCategory': 'Benchmark', 'expense_amount': '0',
+            'budget_id': latest}),
+    }
+
+
+def run(path, requests=200, seed=0, cold=False):
+    """Time each scenario `requests` times against the database at `path`; returns the report."""
+    from app import app, page_cache, user_cache
+
+    rng = random.Random(seed)
+    app.config['DATABASE'] = path
+    client = app.test_client()
+    db = database.connect(path)
+    users = [row[0] for row in db.execute("SELECT UserID FROM User")]
+    if not users:
+        raise SystemExit(f"{path} has no users; run 'generate' first")
+
+    # Trace every connection the app hands out, on this thread and on the query pool
+    statements = []
+    get_connection = database.get_connection
+
+    def traced_get_connection(path, **options):
+        connection = get_connection(path, **options)
+        connection.set_trace_callback(statements.append)
+        return connection
+
+    database.get_connection = traced_get_connection
+    samples = {}
+    try:
+        for _ in range(requests):
+            user_id = rng.choice(users)
+            budget_ids = [row[0] for row in db.execute(
+                "SELECT BudgetID FROM Budget WHERE UserID = ? ORDER BY Year DESC, Month DESC",
+                (user_id,))]
+            categories = [row[0] for row in db.execute(
+                "SELECT Category FROM CategoryTotals WHERE BudgetID = ? AND ExpenseCount > 0",
+                (budget_ids[0],))]
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+
+            for name, (method, url, data) in _scenarios(rng, user_id, budget_ids,
+                                                        categories).items():
+                if cold:
+                    page_cache.clear()
+                    user_cache.clear()
+                statements.clear()
+                started = time.perf_counter()
+                # buffered, so streamed responses are timed to their last byte
+                response = client.open(url, method=method, data=data, buffered=True)
+                elapsed = (time.perf_counter() - started) * 1000
+                if response.status_code >= 400:
+                    raise RuntimeError(f"{name} returned {response.status_code}")
+                samples.setdefault(name, []).append((elapsed, len(statements)))
+    finally:
+        database.get_connection = get_connection
+        database.shutdown_query_pool()
+        database.close_all()
+        db.close()
+
+    report = {}
+    for name, results in samples.items():
+        latencies = [elapsed for elapsed, _ in results]
+        queries = [count for _, count in results]
+        report[name] = {
+            'requests': len(results),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'queries_per_request': round(sum(queries) / len(queries), 2),
+            'max_queries': max(queries),
+        }
+    return report
+
+
+def _latency_summary(latencies):
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+    }
+
+
+def run_logins(path, logins=100, threads=8, workers=(0, auth.DEFAULT_WORKERS), seed=0):
+    """Time a burst of `logins` concurrent logins under each hashing pool size; returns the report.
+
+    Pool size 0 hashes on the request threads. A separate thread keeps
+    requesting the dashboard API during each burst to show what the burst
+    does to everyone else.
+    """
+    import app as app_module
+
+    rng = random.Random(seed)
+    app = app_module.app
+    app.config['DATABASE'] = path
+    db = database.connect(path)
+    users = db.execute("SELECT UserID, Username, Password FROM User").fetchall()
+    if not users:
+        raise SystemExit(f"{path} has no users; run 'generate' first")
+    # Hash with the method the users were stored under, so no login rehashes
+    method = auth.method_of(users[0][2])
+    chosen = [rng.choice(users) for _ in range(logins)]
+
+    def log_in(usernames, latencies):
+        client = app.test_client()
+        for username in usernames:
+            started = time.perf_counter()
+            response = client.post('/login', data={'username': username, 'password': PASSWORD})
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.headers.get('Location') != '/dashboard':
+                raise RuntimeError(f"login for {username} failed")
+
+    def poll_dashboard(latencies, done):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(users[0][0])
+            session['_fresh'] = True
+        while not done.is_set():
+            started = time.perf_counter()
+            client.get('/api/v1/dashboard')
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    report = {}
+    originals = app_module.password_hasher, app_module.login_limiter
+    try:
+        for size in workers:
+            hasher = auth.PasswordHasher(method, size, app.config['AUTH_MAX_CONCURRENT_HASHES'],
+                                         app.config['AUTH_HASH_WAIT_SECONDS'])
+            app_module.password_hasher = hasher
+            app_module.login_limiter = auth.FailedLoginLimiter()
+            if size:
+                hasher.verify(users[0][2], PASSWORD)  # start the pool outside the timing
+            login_latencies, dashboard_latencies = [], []
+            done = threading.Event()
+            poller = threading.Thread(target=poll_dashboard, args=(dashboard_latencies, done))
+            clients = [threading.Thread(target=log_in,
+                                        args=([row[1] for row in chosen[i::threads]],
+                                              login_latencies))
+                       for i in range(threads)]
+            poller.start()
+            started = time.perf_counter()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - started
+            done.set()
+            poller.join()
+            hasher.shutdown()
+            report['inline' if not size else f'pool_{size}'] = {
+                'logins_per_second': round(len(login_latencies) / elapsed, 2),
+                'login': _latency_summary(login_latencies),
+                'dashboard_during_burst': _latency_summary(dashboard_latencies or [0.0]),
+            }
+    finally:
+        app_module.password_hasher, app_module.login_limiter = originals
+        database.shutdown_query_pool()
+        database.close_all()
+        db.close()
+    return report
+
+
+def _spend(path, user_id, budget_id, attempts, start_at, checked=True):
+    """Writer process: add 1.00 transactions, with or without the limit checks."""
+    db = database.connect(path)
+    accepted = refused = 0
+    time.sleep(max(0, start_at - time.time()))
+    started = time.time()
+    for _ in range(attempts):
+        try:
+            if checked:
+                limits.add_transaction(db, user_id, budget_id, 'load', 'Groceries', 1,
+                                       '2024-01-01')
+            else:
+                with transaction(db):
+                    db.execute("""
+                        INSERT INTO "Transaction" (Description, Category, Amount, Date, BudgetID)
+                        VALUES ('load', 'Groceries', 1, '2024-01-01', ?)
+                    """, (budget_id,))
+            accepted += 1
+        except limits.LimitExceeded:
+            refused += 1
+    db.close()
+    return accepted, refused, started, time.time()
+
+
+def contend(path, user_id, budget_id, writers, attempts, checked=True):
+    """Run `writers` processes spending on one budget at once; returns their _spend results."""
+    start_at = time.time() + 1  # let every writer fork before the first write
+    with multiprocessing.get_context('fork').Pool(writers) as pool:
+        return pool.starmap(_spend, [(path, user_id, budget_id, attempts, start_at, checked)] * writers)
+
+
+def run_limits(path, writers=50, attempts=20, limit=None):
+    """Compare concurrent write rates with and without the limit checks; returns the report.
+
+    Each run writes to new budgets of a user of its own, so the generated users'
+    data is left alone. `limit` defaults to half the writes, so the checked run
+    also exercises refusals.
+    """
+    limit = limit or writers * attempts // 2
+    db = database.connect(path)
+    try:
+        name = f'limits{time.time_ns()}'
+        with transaction(db):
+            user_id = db.execute("""
+                INSERT INTO User (FirstName, LastName, AccountType, Username, Email, Password)
+                VALUES ('limits', 'benchmark', 'personal', ?, ?, '')
+            """, (name, f'{name}@example.com')).lastrowid
+        budget_ids = {}
+        for name, account_limit in (('unchecked', writers * attempts), ('checked', limit)):
+            with transaction(db):
+                budget_ids[name] = db.execute("""
+                    INSERT INTO Budget (UserID, AccountLimit, Month, Year, Income)
+                    VALUES (?, ?, 1, 2024, 0)
+                """, (user_id, account_limit)).lastrowid
+                db.execute("INSERT INTO Expense (BudgetID, Category, Amount) "
+                           "VALUES (?, 'Groceries', ?)", (budget_ids[name], account_limit))
+    finally:
+        db.close()
+
+    report = {}
+    for name, budget_id in budget_ids.items():
+        results = contend(path, user_id, budget_id, writers, attempts,
+                          checked=name == 'checked')
+        elapsed = max(r[3] for r in results) - min(r[2] for r in results)
+        report[name] = {
+            'writes_per_second': round(writers * attempts / elapsed, 2),
+            'accepted': sum(r[0] for r in results),
+            'refused': sum(r[1] for r in results),
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='fill a scratch database with synthetic data')
+    gen.add_argument('path')
+    gen.add_argument('--users', type=int, default=100)
+    gen.add_argument('--budgets', type=int, default=12, help='budgets (months) per user')
+    gen.add_argument('--transactions', type=int, default=200, help='transactions per budget')
+    gen.add_argument('--categories', type=int, default=6, help='categories per budget')
+    gen.add_argument('--seed', type=int, default=0)
+
+    bench = commands.add_parser('run', help='benchmark the routes against a database')
+    bench.add_argument('path')
+    bench.add_argument('--requests', type=int, default=200, help='iterations per scenario')
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--cold', action='store_true', help='clear the caches before each request')
+    bench.add_argument('--output', help='write the JSON report here instead of stdout')
+
+    login = commands.add_parser('login', help='benchmark login throughput with and without '
+                                              'the hashing pool')
+    login.add_argument('path')
+    login.add_argument('--logins', type=int, default=100, help='logins per configuration')
+    login.add_argument('--threads', type=int, default=8, help='concurrent login clients')
+    login.add_argument('--workers', type=int, nargs='+', default=[0, auth.DEFAULT_WORKERS],
+                       help='hashing pool sizes to compare; 0 hashes on the request threads')
+    login.add_argument('--seed', type=int, default=0)
+    login.add_argument('--output', help='write the JSON report here instead of stdout')
+
+    spend = commands.add_parser('limits', help='compare concurrent write rates with and '
+                                               'without the limit checks')
+    spend.add_argument('path')
+    spend.add_argument('--writers', type=int, default=50, help='concurrent writer processes')
+    spend.add_argument('--attempts', type=int, default=20, help='transactions per writer')
+    spend.add_argument('--limit', type=int, default=None,
+                       help='account limit of the checked budget (default: half the writes)')
+    spend.add_argument('--output', help='write the JSON report here instead of stdout')
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        started = time.perf_counter()
+        rows = generate(args.path, args.users, args.budgets, args.transactions,
+                        args.categories, args.seed)
+        print(f"Wrote {rows} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        return
+
+    if args.command == 'login':
+        report = run_logins(args.path, args.logins, args.threads, args.workers, args.seed)
+    elif args.command == 'limits':
+        report = run_limits(args.path, args.writers, args.attempts, args.limit)
+    else:
+        report = run(args.path, args.requests, args.seed, args.cold)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# budgets.py
+"""Budget creation: the budget row and all its planned expenses in one transaction.
+
+Expense rows are validated by the caller before anything is written, then
+inserted with a single executemany. A new budget can also start from the
+categories and amounts of the user's previous budget, copied server-side in
+one INSERT ... SELECT.
+"""
+from db import transaction
+
+CLONE_PREVIOUS = """
+    INSERT INTO Expense (BudgetID, Category, Amount)
+    SELECT :budget_id, e.Category, e.Amount
+    FROM Expense e
+    WHERE e.BudgetID = (
+        SELECT BudgetID FROM Budget
+        WHERE UserID = :user_id
+          AND (Year, CAST(Month AS INTEGER)) < (:year, :month)
+        ORDER BY Year DESC, CAST(Month AS INTEGER) DESC
+        LIMIT 1
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM Expense entered
+        WHERE entered.BudgetID = :budget_id AND entered.Category = e.Category
+    )
+"""
+
+
+def parse_expense_rows(form, count):
+    """Read `count` expense rows from the create-budget form.
+
+    Returns (expenses, errors): expenses as (category, amount) pairs, and one
+    message per invalid row. Rows left completely empty are skipped.
+    """
+    expenses, errors = [], []
+    for i in range(1, count + 1):
+        category = (form.get(f'expense_description_{i}') or '').strip()
+        amount = (form.get(f'expense_amount_{i}') or '').strip()
+        if not category and not amount:
+            continue
+        if not category:
+            errors.append(f"Expense {i} needs a category.")
+            continue
+        try:
+            value = float(amount)
+        except ValueError:
+            errors.append(f"Invalid amount for category '{category}'. "
+                          f"Please enter a valid number.")
+            continue
+        if value < 0:
+            errors.append(f"Amount for category '{category}' can't be negative.")
+            continue
+        expenses.append((category, value))
+    return expenses, errors
+
+
+def create_budget(db, user_id, account_limit, month, year, income, expenses=(),
+                  clone_previous=False):
+    """Insert a budget with its expenses; returns (budget_id, number of expenses copied).
+
+    With clone_previous, categories from the user's latest earlier budget that
+    weren't entered explicitly are copied over with their planned amounts.
+    """
+    with transaction(db):
+        budget_id = db.execute("""
+            INSERT INTO Budget (UserID, AccountLimit, Month, Year, Income)
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, account_limit, month, year, income)).lastrowid
+        db.executemany("""
+            INSERT INTO Expense (BudgetID, Category, Amount) VALUES (?, ?, ?)
+        """, [(budget_id, category, amount) for category, amount in expenses])
+        copied = 0
+        if clone_previous:
+            copied = db.execute(CLONE_PREVIOUS, {'budget_id': budget_id, 'user_id': user_id,
+                                                 'year': year, 'month': month}).rowcount
+    return budget_id, copied
@@ -0,0 +1,106 @@
+# cache.py
+"""Caches: an in-process LRU and a Redis-backed store with the same interface.
+
+Both backends implement get/set/delete/clear on JSON-serialisable values, so
+callers can swap one for the other through configuration.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe LRU cache whose entries also expire `ttl` seconds after being stored.
+
+    Keeps hit/miss/eviction counters so the hit rate can be checked under load.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class RedisCache:
+    """Cache backend on a Redis-compatible client (anything with get/set/delete/scan_iter).
+
+    Unlike LRUCache, entries are shared by every worker process, so an
+    invalidation in one worker is seen by all of them.
+    """
+
+    def __init__(self, client, ttl=300, prefix='smartex:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+
+def create_cache(backend, maxsize=1024, ttl=300, redis_url=None):
+    """Build the cache backend named by configuration ('memory' or 'redis')."""
+    if backend == 'memory':
+        return LRUCache(maxsize, ttl)
+    if backend == 'redis':
+        import redis  # only needed when Redis is configured
+        return RedisCache(redis.Redis.from_url(redis_url), ttl)
+    raise ValueError(f"unknown cache backend: {backend!r}")
@@ -0,0 +1,191 @@
+# dashboard_data.py
+"""Data behind the dashboard, history and chart pages, served by /api/v1.
+
+The dashboard is loaded in two queries. The first returns one row per
+planned category of the user's latest budget, with the budget summary and
+reward total repeated on each row (or a single row of NULLs plus the reward
+total when the user has no budget yet).
+The second query fetches the first page of the latest budget's transactions;
+later pages are served by transactions_page() through the JSON API using
+keyset pagination on (Date, TransactionID), so the cost of a page does not
+grow with the budget's history. History and charts read the maintained
+BudgetTotals/CategoryTotals instead of summing transactions.
+
+Month-end projections come from the Forecast table filled by the nightly
+forecast job (see forecast.py). A projection never drops below what has
+been spent since the job ran.
+"""
+import calendar
+
+SUMMARY_QUERY = """
+    WITH latest AS (
+        SELECT BudgetID, AccountLimit, Month, Year
+        FROM Budget
+        WHERE UserID = :user_id
+        ORDER BY Year DESC, CAST(Month AS INTEGER) DESC
+        LIMIT 1
+    ),
+    reward_sum AS (
+        SELECT COALESCE(SUM(Amount), 0) AS RewardTotal
+        FROM Rewards
+        WHERE UserID = :user_id
+    )
+    SELECT latest.BudgetID, latest.AccountLimit, latest.Month, latest.Year,
+           IFNULL(bt.TransactionTotal, 0) AS TotalTransactions,
+           EXISTS (SELECT 1 FROM ArchivedBudget a WHERE a.BudgetID = latest.BudgetID)
+               AS Archived,
+           reward_sum.RewardTotal,
+           ct.Category, ct.Planned, ct.Spent,
+           f.Projected, f.ComputedAt AS ForecastAt
+    FROM reward_sum
+    LEFT JOIN latest
+    LEFT JOIN BudgetTotals bt ON bt.BudgetID = latest.BudgetID
+    LEFT JOIN CategoryTotals ct ON ct.BudgetID = latest.BudgetID AND ct.ExpenseCount > 0
+    LEFT JOIN Forecast f ON f.BudgetID = latest.BudgetID AND f.Category = ct.Category
+    ORDER BY ct.Category
+"""
+
+PAGE_SIZE = 25
+
+# {source} is the hot "Transaction" table, or AllTransactions for archived budgets
+TRANSACTIONS_QUERY = """
+    SELECT TransactionID, Amount, Date, Category, Description
+    FROM {source}
+    WHERE BudgetID = ?
+    ORDER BY Date DESC, TransactionID DESC
+    LIMIT ?
+"""
+
+TRANSACTIONS_AFTER_QUERY = """
+    SELECT TransactionID, Amount, Date, Category, Description
+    FROM {source}
+    WHERE BudgetID = ? AND (Date, TransactionID) < (?, ?)
+    ORDER BY Date DESC, TransactionID DESC
+    LIMIT ?
+"""
+
+
+def encode_cursor(row):
+    return f"{row['Date']}:{row['TransactionID']}"
+
+
+def decode_cursor(cursor):
+    """Split an `after` cursor into (date, transaction id); raises ValueError if malformed."""
+    date, _, transaction_id = cursor.rpartition(':')
+    if not date:
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    return date, int(transaction_id)
+
+
+def transactions_page(db, budget_id, after=None, limit=PAGE_SIZE, archived=False):
+    """Return (rows, next_cursor) for the page of transactions following `after`.
+
+    Pass archived=True for budgets in ArchivedBudget, whose rows live in the archive.
+    """
+    source = 'AllTransactions' if archived else '"Transaction"'
+    if after:
+        date, transaction_id = decode_cursor(after)
+        rows = db.execute(TRANSACTIONS_AFTER_QUERY.format(source=source),
+                          (budget_id, date, transaction_id, limit + 1)).fetchall()
+    else:
+        rows = db.execute(TRANSACTIONS_QUERY.format(source=source),
+                          (budget_id, limit + 1)).fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def load_dashboard(db, user_id):
+    """Return the template context for the dashboard of `user_id`."""
+    rows = db.execute(SUMMARY_QUERY, {'user_id': user_id}).fetchall()
+    first = rows[0]
+    data = {
+        'latest_budget': None,
+        'expenses': [],
+        'categories': [],
+        'transactions': [],
+        'next_cursor': None,
+        'reward_total': first['RewardTotal'],
+        'category_totals': [],
+        'forecast': None,
+    }
+    if first['BudgetID'] is None:
+        return data
+
+    month = first['Month']
+    data['latest_budget'] = {
+        'BudgetID': first['BudgetID'],
+        'AccountLimit': first['AccountLimit'],
+        'Month': month,
+        'Year': first['Year'],
+        'MonthName': calendar.month_name[int(month)] if month else "N/A",
+        'TotalTransactions': first['TotalTransactions'],
+    }
+    forecast = {'Projected': 0, 'Overspending': [], 'ComputedAt': None}
+    for row in rows:
+        if row['Category'] is None:
+            continue
+        projected = None
+        if row['Projected'] is not None:
+            projected = max(row['Projected'], row['Spent'])
+            forecast['Projected'] += projected
+            forecast['ComputedAt'] = row['ForecastAt']
+            if projected > row['Planned'] + 0.005:
+                forecast['Overspending'].append(row['Category'])
+        data['expenses'].append({'Category': row['Category'], 'Amount': row['Planned'],
+                                 'Spent': row['Spent'], 'Projected': projected})
+        data['category_totals'].append({'Category': row['Category'],
+                                        'TotalAmount': row['Planned']})
+        data['categories'].append(row['Category'].capitalize())
+
+    if forecast['ComputedAt'] is not None:
+        forecast['Projected'] = round(forecast['Projected'], 2)
+        forecast['Overspend'] = forecast['Projected'] > first['AccountLimit']
+        data['forecast'] = forecast
+
+    rows, data['next_cursor'] = transactions_page(db, first['BudgetID'],
+                                                  archived=first['Archived'])
+    data['transactions'] = [dict(row) for row in rows]
+    return data
+
+
+def load_history(db, user_id):
+    """Every budget of `user_id`, newest first, with its spending so far."""
+    rows = db.execute("""
+        SELECT b.BudgetID, b.Month, b.Year, b.AccountLimit,
+               COALESCE(bt.TransactionTotal, 0) AS TotalTransactions
+        FROM Budget b
+        LEFT JOIN BudgetTotals bt ON bt.BudgetID = b.BudgetID
+        WHERE b.UserID = ?
+        ORDER BY b.Year DESC, b.Month DESC
+    """, (user_id,))
+    history = []
+    for row in rows:
+        row = dict(row)
+        row['MonthName'] = calendar.month_name[int(row['Month'])] if row['Month'] else "Unknown"
+        history.append(row)
+    return history
+
+
+def load_budget_charts(db, user_id, budget_id):
+    """Planned expenses and spending per category of one budget, or None if it isn't theirs."""
+    budget = db.execute("""
+        SELECT BudgetID, AccountLimit, Month, Year FROM Budget
+        WHERE BudgetID = ? AND UserID = ?
+    """, (budget_id, user_id)).fetchone()
+    if budget is None:
+        return None
+    budget = dict(budget)
+    budget['MonthName'] = calendar.month_name[int(budget['Month'])]
+    expenses = db.execute("""
+        SELECT Category, Amount FROM Expense WHERE BudgetID = ?
+    """, (budget_id,))
+    spending = db.execute("""
+        SELECT Category, Spent AS Total
+        FROM CategoryTotals
+        WHERE BudgetID = ? AND TransactionCount > 0
+    """, (budget_id,))
+    return {'budget': budget,
+            'expenses': [dict(row) for row in expenses],
+            'transactions': [dict(row) for row in spending]}
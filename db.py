@@ -0,0 +1,290 @@
+# db.py
+"""SQLite connection layer.
+
+Connections are opened once per thread and database path, configured with
+WAL journaling and the pragmas below, migrated on first use, and then reused
+by every request that thread serves. Connections run in autocommit mode:
+reads never hold a transaction open, and every write goes through
+transaction(), which takes the write lock up front (BEGIN IMMEDIATE) and
+commits or rolls back in one place. Writes that may outlast busy_timeout
+under contention are wrapped in retry_on_busy().
+
+Async views hand their reads to a small thread pool with run_query(); each
+pool thread keeps its own connection, so the event loop never blocks on
+SQLite.
+
+With SHARDS configured, budgets and everything under them live in one of
+several database files, chosen per user (see shards.py). DATABASE stays the
+directory holding the User table: get_directory() always opens it, while
+get_db() and run_query() open the shard the User row names for
+current_user. That lookup is a primary-key read per request, so a user
+moved by the rebalancer is routed to the new shard on their next request.
+Without SHARDS both return the one database.
+"""
+import asyncio
+import functools
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import current_app, g
+from flask_login import current_user
+
+from instrumentation import InstrumentedConnection, current_log, recording_to
+from migrations import migrate
+
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_MMAP_SIZE = 64 * 1024 * 1024
+DEFAULT_CACHE_SIZE_KB = 16 * 1024
+BUSY_RETRIES = 5
+BUSY_BACKOFF_SECONDS = 0.05
+DEFAULT_QUERY_POOL_SIZE = 4
+# Shard of users placed before sharding was configured (User.Shard IS NULL)
+DEFAULT_SHARD = 'main'
+
+_local = threading.local()
+_migrated = set()
+_migrate_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+TRANSACTION_COLUMNS = "TransactionID, Amount, Date, Category, Description, BudgetID"
+
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS archive."Transaction" (
+        TransactionID INTEGER NOT NULL,
+        Amount REAL NOT NULL,
+        Date DATE NOT NULL,
+        Category TEXT,
+        Description TEXT,
+        BudgetID INTEGER NOT NULL,
+        PRIMARY KEY (BudgetID, Date, TransactionID)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS archive.idx_archive_transaction_id
+        ON "Transaction" (TransactionID);
+    -- Same layout as the hot TransactionSearch index (migration 8)
+    CREATE VIRTUAL TABLE IF NOT EXISTS archive.TransactionSearch USING fts5(
+        Description, Category, BudgetID,
+        content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+    );
+"""
+
+
+def attach_archive(db, path):
+    """Attach the cold-store database at `path` as schema `archive`, creating it if needed."""
+    db.execute("ATTACH DATABASE ? AS archive", (path,))
+    db.execute("PRAGMA archive.journal_mode = WAL")
+    db.executescript(ARCHIVE_SCHEMA)
+
+
+def install_views(db):
+    """Create the TEMP view AllTransactions: hot rows plus any archived ones.
+
+    A row copied to the archive but not yet deleted from the hot table (an
+    archival run interrupted between its two steps) is only counted once.
+    """
+    attached = any(row[1] == 'archive' for row in db.execute("PRAGMA database_list"))
+    archived = f"""
+        UNION ALL
+        SELECT {TRANSACTION_COLUMNS} FROM archive."Transaction" a
+        WHERE NOT EXISTS (SELECT 1 FROM main."Transaction" m
+                          WHERE m.TransactionID = a.TransactionID)
+    """ if attached else ""
+    db.execute(f"""
+        CREATE TEMP VIEW IF NOT EXISTS AllTransactions AS
+        SELECT {TRANSACTION_COLUMNS} FROM main."Transaction" {archived}
+    """)
+
+
+def connect(path, busy_timeout=DEFAULT_BUSY_TIMEOUT_MS, mmap_size=DEFAULT_MMAP_SIZE,
+            cache_size_kb=DEFAULT_CACHE_SIZE_KB, auto_migrate=True, factory=sqlite3.Connection,
+            archive_path=None):
+    """Open a configured connection to `path`, migrated to the latest schema unless told not to.
+
+    With `archive_path`, the archive database is attached and AllTransactions
+    reads across both stores.
+    """
+    db = sqlite3.connect(path, timeout=busy_timeout / 1000, isolation_level=None,
+                         factory=factory)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+    db.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+    db.execute(f"PRAGMA cache_size = -{int(cache_size_kb)}")
+    db.execute("PRAGMA temp_store = MEMORY")
+    if auto_migrate and path not in _migrated:
+        with _migrate_lock:
+            if path not in _migrated:
+                migrate(db)
+                _migrated.add(path)
+    if archive_path:
+        attach_archive(db, archive_path)
+    install_views(db)
+    return db
+
+
+def get_connection(path, **options):
+    """Return this thread's connection to `path`, opening it on first use."""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    db = connections.get(path)
+    if db is None:
+        db = connections[path] = connect(path, **options)
+    return db
+
+
+def close_all():
+    """Close every connection opened by the calling thread."""
+    for db in getattr(_local, 'connections', {}).values():
+        db.close()
+    _local.connections = {}
+
+
+def archive_path(config, path):
+    """Cold store for the database at `path`: one per shard, named after it."""
+    archive = config['ARCHIVE_DATABASE']
+    shards = config['SHARDS']
+    if not archive or not shards or path == config['DATABASE']:
+        return archive
+    for name, shard_path in shards.items():
+        if shard_path == path:
+            stem, ext = os.path.splitext(archive)
+            return f"{stem}-{name}{ext}"
+    raise ValueError(f"{path} is neither DATABASE nor one of SHARDS, so it has no archive.")
+
+
+def _options(config, path):
+    return {
+        'busy_timeout': config['SQLITE_BUSY_TIMEOUT_MS'],
+        'mmap_size': config['SQLITE_MMAP_SIZE'],
+        'cache_size_kb': config['SQLITE_CACHE_SIZE_KB'],
+        'factory': (InstrumentedConnection if config['SQL_INSTRUMENTATION']
+                    else sqlite3.Connection),
+        'archive_path': archive_path(config, path),
+    }
+
+
+def open_database(config, path):
+    """A new connection to `path`, configured like the app's; the caller closes it."""
+    return connect(path, **_options(config, path))
+
+
+def get_directory():
+    """This request's connection to the directory database (the User table)."""
+    if 'directory_db' not in g:
+        path = current_app.config['DATABASE']
+        g.directory_db = get_connection(path, **_options(current_app.config, path))
+    return g.directory_db
+
+
+def shard_of(directory, user_id):
+    """Name of the shard holding `user_id`'s budgets."""
+    row = directory.execute("SELECT Shard FROM User WHERE UserID = ?", (user_id,)).fetchone()
+    return (row[0] if row else None) or DEFAULT_SHARD
+
+
+def current_shard():
+    """The shard this request works on; None when the app isn't sharded."""
+    if not current_app.config['SHARDS']:
+        return None
+    if 'shard' not in g:
+        g.shard = (shard_of(get_directory(), current_user.id)
+                   if current_user and current_user.is_authenticated else DEFAULT_SHARD)
+    return g.shard
+
+
+def _path():
+    config = current_app.config
+    shard = current_shard()
+    if shard is None:
+        return config['DATABASE']
+    if shard not in config['SHARDS']:
+        raise LookupError(f"User {current_user.id} is on shard {shard!r}, which isn't in SHARDS.")
+    return config['SHARDS'][shard]
+
+
+def get_db():
+    """This request's connection to the current user's shard (the directory when signed out)."""
+    if 'sqlite_db' not in g:
+        path = _path()
+        g.sqlite_db = get_connection(path, **_options(current_app.config, path))
+    return g.sqlite_db
+
+
+def _query_pool(size):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(size, thread_name_prefix='sqlite-query')
+        return _pool
+
+
+def _run(path, options, log, query, args):
+    with recording_to(log):
+        return query(get_connection(path, **options), *args)
+
+
+async def run_query(query, *args):
+    """Await `query(db, *args)` run on the query pool against the app's database."""
+    config = current_app.config
+    path = _path()
+    call = functools.partial(_run, path, _options(config, path), current_log(), query, args)
+    pool = _query_pool(config['QUERY_POOL_SIZE'])
+    return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+
+def shutdown_query_pool():
+    """Stop the query pool; its threads' connections are closed as the threads exit."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def close_db(error=None):
+    """Hand the request's connections back, discarding anything they left uncommitted."""
+    g.pop('shard', None)
+    for name in ('sqlite_db', 'directory_db'):
+        db = g.pop(name, None)
+        if db is not None and db.in_transaction:
+            db.rollback()
+
+
+@contextmanager
+def transaction(db):
+    """Run the block as one write transaction, committing on success and rolling back on error."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
+def is_busy(error):
+    """True for the errors SQLite raises when another connection holds the lock."""
+    return (isinstance(error, sqlite3.OperationalError)
+            and str(error).startswith(('database is locked', 'database is busy')))
+
+
+def retry_on_busy(write, retries=BUSY_RETRIES, backoff=BUSY_BACKOFF_SECONDS):
+    """Call `write()`, retrying with jittered exponential backoff while the database is busy.
+
+    `write` must run its own transaction() so every attempt starts from scratch.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return write()
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
@@ -0,0 +1,192 @@
+# exports.py
+"""Streamed exports of a user's transactions as CSV, JSON Lines or XLSX.
+
+export_chunks() walks the budgets one at a time and reads each through a
+cursor, CHUNK_SIZE rows per fetchmany(). Hot rows come in index order
+(BudgetID, Date) and archived ones in the archive's primary-key order, so
+SQLite never sorts or buffers a result and nothing holds more than one
+chunk. The writers turn each chunk into bytes as soon as it's read:
+
+- CSV, with text cells that a spreadsheet would run as a formula prefixed
+  with an apostrophe;
+- JSON Lines, one object per transaction;
+- XLSX, written with zipfile to a sink the generator drains after every
+  chunk. The sheet uses inline strings, so there's no shared-string table
+  to build up front.
+
+The route wraps the result in stream_with_context(), so the request's
+connection stays open until the last chunk is sent.
+"""
+import csv
+import io
+import json
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from archive import is_attached
+
+CHUNK_SIZE = 1000
+
+COLUMNS = ('TransactionID', 'BudgetID', 'Year', 'Month', 'Date', 'Category', 'Description',
+           'Amount')
+
+# format: (mimetype, file extension)
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+HOT_ROWS = """
+    SELECT TransactionID, Date, Category, Description, Amount
+    FROM main."Transaction"
+    WHERE BudgetID = ?
+    ORDER BY Date, TransactionID
+"""
+
+# Rows caught mid-archival are in both stores; the hot copy was already sent
+ARCHIVED_ROWS = """
+    SELECT TransactionID, Date, Category, Description, Amount
+    FROM archive."Transaction" a
+    WHERE BudgetID = ?
+      AND NOT EXISTS (SELECT 1 FROM main."Transaction" m WHERE m.TransactionID = a.TransactionID)
+    ORDER BY BudgetID, Date, TransactionID
+"""
+
+FORMULA_START = ('=', '+', '-', '@', '\t', '\r')
+XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def user_budgets(db, user_id, budget_id=None):
+    """[(BudgetID, Year, Month)] of the user's budgets, oldest first; one with `budget_id`."""
+    query = "SELECT BudgetID, Year, CAST(Month AS INTEGER) FROM Budget WHERE UserID = ?"
+    params = [user_id]
+    if budget_id is not None:
+        query += " AND BudgetID = ?"
+        params.append(budget_id)
+    return db.execute(query + " ORDER BY Year, CAST(Month AS INTEGER), BudgetID",
+                      params).fetchall()
+
+
+def export_chunks(db, budgets, chunk_size=None):
+    """Yield lists of up to `chunk_size` rows, one tuple per transaction, in COLUMNS order."""
+    chunk_size = chunk_size or CHUNK_SIZE
+    queries = [HOT_ROWS, ARCHIVED_ROWS] if is_attached(db) else [HOT_ROWS]
+    for budget_id, year, month in budgets:
+        for query in queries:
+            cursor = db.execute(query, (budget_id,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [(transaction_id, budget_id, year, month, date, category, description,
+                        amount)
+                       for transaction_id, date, category, description, amount in rows]
+
+
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_START):
+        return "'" + value
+    return value
+
+
+def write_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for chunk in chunks:
+        writer.writerows([_csv_cell(value) for value in row] for row in chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def write_jsonl(chunks):
+    for chunk in chunks:
+        yield ''.join(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in chunk).encode('utf-8')
+
+
+class _Sink:
+    """Write-only file for zipfile; the generator takes what was written after each chunk."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Transactions" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+}
+
+
+def _xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value!r}</v></c>'
+    text = escape(XML_INVALID.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_row(row):
+    return '<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>'
+
+
+def write_xlsx(chunks):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_PARTS.items():
+            workbook.writestr(name, content)
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                         '<sheetData>' + _xlsx_row(COLUMNS)).encode('utf-8'))
+            for chunk in chunks:
+                sheet.write(''.join(_xlsx_row(row) for row in chunk).encode('utf-8'))
+                yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'xlsx': write_xlsx}
+
+
+def stream_export(db, budgets, file_format, chunk_size=None):
+    """Bytes of the export of `budgets` in `file_format`, generated a chunk at a time."""
+    return WRITERS[file_format](export_chunks(db, budgets, chunk_size))
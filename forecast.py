@@ -0,0 +1,143 @@
+# forecast.py
+"""Month-end spending forecasts for every active budget, computed in bulk.
+
+A budget is active during its own month. forecast_spending() walks the
+active budgets in batches; for each batch it runs two queries and does the
+arithmetic on NumPy arrays, one element per (budget, category) series:
+
+1. the series themselves: planned and spent from CategoryTotals, plus the
+   user's average monthly spend on the category over the previous
+   HISTORY_MONTHS months from MonthlyRollup;
+2. this month's spending per series and day, scattered into a
+   series x day matrix.
+
+The pace of each series is an exponentially weighted mean of its daily
+spending (recent days count more), and the pace estimate is what's spent
+plus that rate over the remaining days. Early in the month the usual
+monthly spend from history weighs more, late in the month the pace does.
+A series is flagged when its projection exceeds what was planned.
+
+Results replace the batch's rows in Forecast, which the dashboard reads.
+Schedule it nightly, e.g. from cron:
+
+    30 2 * * *  cd /srv/smartex && flask forecast-spending
+"""
+import calendar
+from datetime import date
+
+import numpy as np
+
+from analytics import months_back
+from db import transaction
+
+BATCH_SIZE = 5000
+HISTORY_MONTHS = 6
+HALF_LIFE_DAYS = 7
+
+ACTIVE_BUDGETS = """
+    SELECT BudgetID FROM Budget
+    WHERE Year = :year AND CAST(Month AS INTEGER) = :month
+    ORDER BY BudgetID
+"""
+
+# Series of a batch, in the order both queries number them
+SERIES = """
+    SELECT ct.BudgetID, ct.Category, ct.Planned, ct.Spent,
+           ROW_NUMBER() OVER (ORDER BY ct.BudgetID, ct.Category) - 1 AS Series,
+           b.UserID
+    FROM Budget b
+    JOIN CategoryTotals ct ON ct.BudgetID = b.BudgetID AND ct.ExpenseCount > 0
+    WHERE b.BudgetID BETWEEN :first AND :last
+      AND b.Year = :year AND CAST(b.Month AS INTEGER) = :month
+"""
+
+SERIES_WITH_HISTORY = f"""
+    SELECT s.BudgetID, s.Category, s.Planned, s.Spent,
+           (SELECT AVG(m.Spent) FROM MonthlyRollup m
+            WHERE m.UserID = s.UserID AND m.Category = s.Category
+              AND (m.Year, m.Month) >= (:history_year, :history_month)
+              AND (m.Year, m.Month) < (:year, :month)) AS HistoryMonthly
+    FROM ({SERIES}) AS s
+    ORDER BY s.Series
+"""
+
+DAILY_SPENDING = f"""
+    SELECT s.Series, CAST(substr(t.Date, 9, 2) AS INTEGER) AS Day, SUM(t.Amount)
+    FROM ({SERIES}) AS s
+    JOIN "Transaction" t ON t.BudgetID = s.BudgetID AND t.Category = s.Category
+    WHERE t.Date >= :start AND t.Date < :end
+    GROUP BY s.Series, Day
+"""
+
+
+def project(planned, spent, history, daily, days_in_month):
+    """Vectorized projection for n series.
+
+    planned, spent and history (NaN where there is none) have shape (n,);
+    daily has shape (n, days elapsed). Returns (daily rate, projected month
+    total, overspend flags).
+    """
+    elapsed = daily.shape[1]
+    weights = 0.5 ** ((elapsed - 1 - np.arange(elapsed)) / HALF_LIFE_DAYS)
+    rate = daily @ weights / weights.sum()
+    pace = spent + rate * (days_in_month - elapsed)
+    usual = np.fmax(spent, history)  # fmax: NaN history falls back to spent
+    trust = elapsed / days_in_month
+    projected = np.where(np.isnan(history), pace, trust * pace + (1 - trust) * usual)
+    return rate, projected, projected > planned + 0.005
+
+
+def forecast_spending(db, as_of=None, batch_size=BATCH_SIZE):
+    """Forecast every budget of `as_of`'s month; returns (budgets, series, series flagged)."""
+    as_of = as_of or date.today()
+    year, month = as_of.year, as_of.month
+    days_in_month = calendar.monthrange(year, month)[1]
+    history_year, history_month = months_back(year, month, HISTORY_MONTHS + 1)
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    params = {'year': year, 'month': month,
+              'history_year': history_year, 'history_month': history_month,
+              'start': f'{year}-{month:02d}-01',
+              'end': f'{next_year}-{next_month:02d}-01'}
+
+    budget_ids = [row[0] for row in db.execute(ACTIVE_BUDGETS, params)]
+    series_count = flagged = 0
+    for start in range(0, len(budget_ids), batch_size):
+        batch = budget_ids[start:start + batch_size]
+        params.update(first=batch[0], last=batch[-1])
+
+        rows = db.execute(SERIES_WITH_HISTORY, params).fetchall()
+        if not rows:
+            continue
+        keys = [(row[0], row[1]) for row in rows]
+        values = np.array([row[2:] for row in rows], dtype=float)  # None -> NaN
+        planned, spent, history = values.T
+
+        daily = np.zeros((len(rows), as_of.day))
+        cells = np.array(db.execute(DAILY_SPENDING, params).fetchall(), dtype=float)
+        if len(cells):
+            series, day, amount = cells.T
+            inside = day <= as_of.day  # transactions dated later this month don't have a pace yet
+            np.add.at(daily, (series[inside].astype(int), day[inside].astype(int) - 1),
+                      amount[inside])
+
+        rate, projected, overspend = project(planned, spent, history, daily, days_in_month)
+        with transaction(db):
+            db.execute("DELETE FROM Forecast WHERE BudgetID BETWEEN ? AND ?",
+                       (batch[0], batch[-1]))
+            db.executemany("""
+                INSERT INTO Forecast (BudgetID, Category, DailyRate, Projected, Overspend)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(budget_id, category, r, p, o) for (budget_id, category), r, p, o
+                  in zip(keys, np.round(rate, 2).tolist(), np.round(projected, 2).tolist(),
+                         overspend.tolist())])
+        series_count += len(rows)
+        flagged += int(overspend.sum())
+
+    # Closed budgets don't need a forecast any more
+    with transaction(db):
+        db.execute("""
+            DELETE FROM Forecast WHERE BudgetID IN (
+                SELECT BudgetID FROM Budget
+                WHERE (Year, CAST(Month AS INTEGER)) < (:year, :month))
+        """, params)
+    return len(budget_ids), series_count, flagged
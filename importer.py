@@ -0,0 +1,174 @@
+# importer.py
+"""Bulk import of bank-statement transactions from CSV or OFX files.
+
+Rows are parsed and validated one at a time from the open file, then
+written with executemany in one transaction per chunk. The overall and
+per-category limits add_transaction enforces are checked inside that
+transaction, against BudgetTotals/CategoryTotals read after BEGIN IMMEDIATE
+and kept as running totals across the chunk, so a concurrent import or
+add_transaction can't slip in between the check and the insert.
+"""
+import csv
+import re
+from datetime import datetime
+
+from db import retry_on_busy, transaction
+
+CHUNK_SIZE = 500
+
+OFX_TAG = re.compile(r'<(\w+)>([^<\r\n]*)')
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.rejected = []  # (line number, reason)
+
+    def reject(self, line, reason):
+        self.rejected.append((line, reason))
+
+
+def parse_csv(stream):
+    """Yield (line number, row) from a CSV with Date, Description, Category and Amount columns."""
+    reader = csv.DictReader(stream)
+    if reader.fieldnames is None:
+        return
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    for row in reader:
+        yield reader.line_num, {
+            'date': (row.get('date') or '').strip(),
+            'description': (row.get('description') or '').strip(),
+            'category': (row.get('category') or '').strip(),
+            'amount': (row.get('amount') or '').strip(),
+        }
+
+
+def parse_ofx(stream, category=''):
+    """Yield (line number, row) for each <STMTTRN> block of an OFX/QFX statement.
+
+    OFX has no notion of our budget categories, so every row gets `category`.
+    Debits (negative TRNAMT) become positive spending amounts; credits come out
+    negative and are rejected by import_transactions.
+    """
+    current = None
+    start = 0
+    for line_no, line in enumerate(stream, 1):
+        upper = line.upper()
+        if '<STMTTRN>' in upper:
+            current, start = {}, line_no
+        elif '</STMTTRN>' in upper and current is not None:
+            amount = current.get('TRNAMT', '')
+            amount = amount[1:] if amount.startswith('-') else f"-{amount}"
+            yield start, {
+                'date': current.get('DTPOSTED', '')[:8],
+                'description': current.get('NAME') or current.get('MEMO', ''),
+                'category': category,
+                'amount': amount,
+            }
+            current = None
+        if current is not None:
+            for tag, value in OFX_TAG.findall(line):
+                current[tag.upper()] = value.strip()
+
+
+def _parse_date(value):
+    for fmt in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def _limits(db, budget_id):
+    """(account limit, transaction total, {category: planned}, {category: spent})."""
+    budget = db.execute("""
+        SELECT b.AccountLimit, IFNULL(bt.TransactionTotal, 0) AS TransactionTotal
+        FROM Budget b
+        LEFT JOIN BudgetTotals bt ON bt.BudgetID = b.BudgetID
+        WHERE b.BudgetID = ?
+    """, (budget_id,)).fetchone()
+    if not budget:
+        raise LookupError(f"budget {budget_id} not found")
+    planned, spent = {}, {}
+    for row in db.execute("""
+        SELECT Category, Planned, Spent FROM CategoryTotals
+        WHERE BudgetID = ? AND ExpenseCount > 0
+    """, (budget_id,)):
+        planned[row['Category']] = row['Planned']
+        spent[row['Category']] = row['Spent']
+    return float(budget['AccountLimit']), budget['TransactionTotal'], planned, spent
+
+
+def _flush(db, budget_id, batch, result):
+    """Insert the rows of `batch` [(line, row)] that fit the limits as they are now."""
+    if not batch:
+        return
+
+    def write():
+        accepted, rejected = [], []
+        with transaction(db):
+            account_limit, total, planned, spent = _limits(db, budget_id)
+            for line, (description, category, amount, date) in batch:
+                if category not in planned:
+                    rejected.append((line, f"No defined expense for '{category}'."))
+                elif total + amount > account_limit:
+                    rejected.append((line, "Would exceed your overall account limit."))
+                elif spent[category] + amount > planned[category]:
+                    rejected.append(
+                        (line, f"Would exceed your budget for the '{category}' category."))
+                else:
+                    total += amount
+                    spent[category] += amount
+                    accepted.append((description, category, amount, date, budget_id))
+            db.executemany("""
+                INSERT INTO "Transaction" (Description, Category, Amount, Date, BudgetID)
+                VALUES (?, ?, ?, ?, ?)
+            """, accepted)
+        return accepted, rejected
+
+    accepted, rejected = retry_on_busy(write)
+    result.imported += len(accepted)
+    result.rejected += rejected
+    batch.clear()
+
+
+def import_transactions(db, budget_id, rows, chunk_size=CHUNK_SIZE):
+    """Validate and insert parsed rows into `budget_id`; returns an ImportResult."""
+    result = ImportResult()
+    # Category names only, to match case-insensitively; the limits are read per chunk
+    _, _, planned, _ = _limits(db, budget_id)
+    names = {}
+    for category in planned:
+        names.setdefault(category.casefold(), category)
+
+    batch = []
+    for line, row in rows:
+        try:
+            amount = float(row['amount'])
+        except ValueError:
+            result.reject(line, f"Invalid amount '{row['amount']}'.")
+            continue
+        if amount <= 0:
+            result.reject(line, "Amount must be positive.")
+            continue
+        try:
+            date = _parse_date(row['date'])
+        except ValueError:
+            result.reject(line, f"Invalid date '{row['date']}'.")
+            continue
+
+        category = row['category']
+        if category not in planned:
+            category = names.get(category.casefold())
+        if category is None:
+            result.reject(line, f"No defined expense for '{row['category']}'.")
+            continue
+
+        batch.append((line, (row['description'], category, amount, date)))
+        if len(batch) >= chunk_size:
+            _flush(db, budget_id, batch, result)
+
+    _flush(db, budget_id, batch, result)
+    result.rejected.sort()
+    return result
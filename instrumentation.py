@@ -0,0 +1,216 @@
+# instrumentation.py
+"""Per-request SQL and timing instrumentation.
+
+When SQL_INSTRUMENTATION is on, connections are opened with
+InstrumentedConnection, which records every statement's text, duration
+(execute plus fetches) and row count into the current request's log.
+After each request the totals feed per-route histograms, exposed at
+/metrics in the Prometheus text format. Statements slower than
+SLOW_QUERY_MS are logged with their EXPLAIN QUERY PLAN.
+
+When it is off, connections are plain sqlite3 connections and the request
+hooks return after a single config lookup.
+Metrics are kept per process; with several workers, scrape each one.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import Response, current_app, request
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+# Context variables rather than thread-locals, so async views (which Flask runs
+# on an event loop thread) see the log of the request they belong to
+_log = ContextVar('sql_log', default=None)
+_started = ContextVar('request_started', default=0.0)
+slow_query_seconds = 0.1
+
+
+def current_log():
+    """Statement records for the request running on this thread, or None outside one."""
+    return _log.get()
+
+
+@contextmanager
+def recording_to(log):
+    """Record statements run on this thread into `log`, e.g. a request's log on a pool thread."""
+    token = _log.set(log)
+    try:
+        yield
+    finally:
+        _log.reset(token)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _record = None
+
+    def _run(self, method, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return method(self, sql, parameters)
+        finally:
+            duration = time.perf_counter() - started
+            log = current_log()
+            if log is not None:
+                self._record = {'sql': sql, 'duration': duration, 'rows': max(self.rowcount, 0)}
+                log.append(self._record)
+            if duration >= slow_query_seconds:
+                _log_slow_query(self.connection, sql, parameters, duration)
+
+    def _fetched(self, started, rows):
+        if self._record is not None:
+            self._record['duration'] += time.perf_counter() - started
+            self._record['rows'] += rows
+
+    def execute(self, sql, parameters=()):
+        return self._run(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(sqlite3.Cursor.executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._fetched(started, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements all go through InstrumentedCursor."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _log_slow_query(db, sql, parameters, duration):
+    plan = ''
+    if sql.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE')):
+        try:
+            rows = sqlite3.Connection.execute(db, f"EXPLAIN QUERY PLAN {sql}", parameters)
+            plan = '\n'.join(f"  {row[3]}" for row in rows)
+        except sqlite3.Error as e:
+            plan = f"  (no plan: {e})"
+    logger.warning("Slow query (%.1f ms):\n%s\n%s", duration * 1000, sql.strip(), plan)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with one series per route label."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, value):
+        with self._lock:
+            series = self._series.get(route)
+            if series is None:
+                series = self._series[route] = {'buckets': [0] * len(self.buckets),
+                                                'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for route, series in sorted(self._series.items()):
+                for bound, bucket in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{{route="{route}",le="{bound}"}} {bucket}')
+                lines.append(f'{self.name}_bucket{{route="{route}",le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{route="{route}"}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{route="{route}"}} {series["count"]}')
+        return lines
+
+
+request_duration = Histogram('smartex_request_duration_seconds',
+                             'Time spent handling a request.', DURATION_BUCKETS)
+sql_duration = Histogram('smartex_sql_duration_seconds',
+                         'Time spent in SQL per request.', DURATION_BUCKETS)
+sql_queries = Histogram('smartex_sql_queries_per_request',
+                        'SQL statements run per request.', QUERY_COUNT_BUCKETS)
+sql_rows = Histogram('smartex_sql_rows_per_request',
+                     'Rows read or written by SQL per request.', QUERY_COUNT_BUCKETS)
+
+
+def _start_request():
+    if current_app.config['SQL_INSTRUMENTATION']:
+        _log.set([])
+        _started.set(time.perf_counter())
+
+
+def _finish_request(response):
+    log = current_log()
+    if log is not None:
+        route = request.endpoint or 'unmatched'
+        request_duration.observe(route, time.perf_counter() - _started.get())
+        sql_duration.observe(route, sum(record['duration'] for record in log))
+        sql_queries.observe(route, len(log))
+        sql_rows.observe(route, sum(record['rows'] for record in log))
+    return response
+
+
+def _end_request(error=None):
+    _log.set(None)
+
+
+def init_app(app, caches=None):
+    """Install the request hooks and the /metrics route.
+
+    `caches` maps a name to any cache with a stats() method; their counters are
+    published alongside the request metrics.
+    """
+    global slow_query_seconds
+    slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000
+    caches = {name: cache for name, cache in (caches or {}).items() if hasattr(cache, 'stats')}
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_end_request)
+
+    @app.route('/metrics')
+    def metrics():
+        lines = []
+        for histogram in (request_duration, sql_duration, sql_queries, sql_rows):
+            lines += histogram.render()
+        for stat in ('hits', 'misses', 'evictions'):
+            name = f"smartex_cache_{stat}_total"
+            lines += [f"# HELP {name} Cache {stat}.", f"# TYPE {name} counter"]
+            lines += [f'{name}{{cache="{cache_name}"}} {cache.stats()[stat]}'
+                      for cache_name, cache in caches.items()]
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,218 @@
+# ledger.py
+"""Replay of the append-only event ledger into the derived totals.
+
+Triggers from migration 7 append one Ledger row per budget, expense and
+transaction change, inside the same transaction as the change itself, so
+the ledger holds every write no matter which code path made it. Ledger
+rows can't be updated or deleted.
+
+Replay folds the events into shadow copies of the totals
+(ReplayBudgetTotals/ReplayCategoryTotals) a chunk at a time. Each chunk is
+a short transaction that also moves the checkpoint in LedgerCheckpoint, so
+writers only ever wait for one chunk. A later run resumes from the
+checkpoint and only reads the events appended since. Within a chunk,
+events are aggregated per budget and category with set-based SQL; a
+budget deleted in the chunk drops its state and every earlier event.
+
+apply_replay() catches up to the head of the ledger and then corrects only
+the live BudgetTotals/CategoryTotals rows that differ from the replay. The
+MonthlyRollup triggers carry those corrections into the rollups, and
+Budget.TotalTransactions is refreshed for the budgets touched. Rewards are
+settled from BudgetTotals, so run `flask settle-rewards` afterwards if
+totals of closed budgets changed.
+
+    flask replay-ledger --apply          # incremental catch-up, then repair
+    flask replay-ledger --full --apply   # rebuild the replay from event 1
+"""
+from db import retry_on_busy, transaction
+from totals import TOLERANCE
+
+PROJECTION = 'totals'
+CHUNK_SIZE = 10000
+
+# Events of one chunk, minus those superseded by a later budget_deleted in it
+CHUNK_EVENTS = """
+    WITH deleted AS (
+        SELECT BudgetID, MAX(EventID) AS EventID
+        FROM Ledger
+        WHERE EventID > :after AND EventID <= :upto AND Kind = 'budget_deleted'
+        GROUP BY BudgetID
+    ),
+    events AS (
+        SELECT l.*
+        FROM Ledger l
+        LEFT JOIN deleted d ON d.BudgetID = l.BudgetID
+        WHERE l.EventID > :after AND l.EventID <= :upto
+          AND l.EventID > IFNULL(d.EventID, 0)
+    )
+"""
+
+SPENT = """CASE e.Kind WHEN 'transaction_added' THEN e.Amount
+                      WHEN 'transaction_removed' THEN -e.Amount ELSE 0 END"""
+PLANNED = """CASE e.Kind WHEN 'expense_added' THEN e.Amount
+                        WHEN 'expense_removed' THEN -e.Amount ELSE 0 END"""
+TRANSACTIONS = """CASE e.Kind WHEN 'transaction_added' THEN e.Count
+                             WHEN 'transaction_removed' THEN -e.Count ELSE 0 END"""
+EXPENSES = """CASE e.Kind WHEN 'expense_added' THEN e.Count
+                         WHEN 'expense_removed' THEN -e.Count ELSE 0 END"""
+
+REPLAY_BUDGET_TOTALS = f"""
+    {CHUNK_EVENTS}
+    INSERT INTO ReplayBudgetTotals (BudgetID, TransactionTotal, ExpenseTotal)
+    SELECT e.BudgetID, SUM({SPENT}), SUM({PLANNED})
+    FROM events e
+    WHERE e.Kind != 'budget_changed'
+    GROUP BY e.BudgetID
+    ON CONFLICT (BudgetID) DO UPDATE
+    SET TransactionTotal = TransactionTotal + excluded.TransactionTotal,
+        ExpenseTotal = ExpenseTotal + excluded.ExpenseTotal
+"""
+
+REPLAY_CATEGORY_TOTALS = f"""
+    {CHUNK_EVENTS}
+    INSERT INTO ReplayCategoryTotals
+        (BudgetID, Category, Planned, Spent, ExpenseCount, TransactionCount)
+    SELECT e.BudgetID, e.Category, SUM({PLANNED}), SUM({SPENT}), SUM({EXPENSES}),
+           SUM({TRANSACTIONS})
+    FROM events e
+    WHERE e.Category IS NOT NULL
+    GROUP BY e.BudgetID, e.Category
+    ON CONFLICT (BudgetID, Category) DO UPDATE
+    SET Planned = Planned + excluded.Planned,
+        Spent = Spent + excluded.Spent,
+        ExpenseCount = ExpenseCount + excluded.ExpenseCount,
+        TransactionCount = TransactionCount + excluded.TransactionCount
+"""
+
+
+def checkpoint(db):
+    """EventID of the last event folded into the replay (0 before the first run)."""
+    row = db.execute("SELECT EventID FROM LedgerCheckpoint WHERE Projection = ?",
+                     (PROJECTION,)).fetchone()
+    return row[0] if row else 0
+
+
+def _replay_chunk(db, chunk_size):
+    """Fold the next `chunk_size` events into the replay; returns how many there were.
+
+    Must run inside a transaction.
+    """
+    after = checkpoint(db)
+    count, upto = db.execute("""
+        SELECT COUNT(*), MAX(EventID)
+        FROM (SELECT EventID FROM Ledger WHERE EventID > ? ORDER BY EventID LIMIT ?)
+    """, (after, chunk_size)).fetchone()
+    if not count:
+        return 0
+    params = {'after': after, 'upto': upto}
+    for table in ('ReplayBudgetTotals', 'ReplayCategoryTotals'):
+        db.execute(f"""
+            DELETE FROM {table} WHERE BudgetID IN (
+                SELECT BudgetID FROM Ledger
+                WHERE EventID > :after AND EventID <= :upto AND Kind = 'budget_deleted')
+        """, params)
+    db.execute(REPLAY_BUDGET_TOTALS, params)
+    db.execute(REPLAY_CATEGORY_TOTALS, params)
+    db.execute("""
+        INSERT INTO LedgerCheckpoint (Projection, EventID) VALUES (?, ?)
+        ON CONFLICT (Projection) DO UPDATE
+        SET EventID = excluded.EventID, UpdatedAt = CURRENT_TIMESTAMP
+    """, (PROJECTION, upto))
+    return count
+
+
+def reset_replay(db):
+    """Forget the replayed totals so the next catch-up starts from the first event."""
+    with transaction(db):
+        db.execute("DELETE FROM ReplayBudgetTotals")
+        db.execute("DELETE FROM ReplayCategoryTotals")
+        db.execute("DELETE FROM LedgerCheckpoint WHERE Projection = ?", (PROJECTION,))
+
+
+def catch_up(db, chunk_size=CHUNK_SIZE):
+    """Replay every event after the checkpoint, one transaction per chunk; returns the count."""
+    def chunk():
+        with transaction(db):
+            return _replay_chunk(db, chunk_size)
+
+    replayed = 0
+    while True:
+        count = retry_on_busy(chunk)
+        replayed += count
+        if count < chunk_size:
+            return replayed
+
+
+def apply_replay(db, chunk_size=CHUNK_SIZE):
+    """Catch up, then make the live totals match the replay.
+
+    Returns {table: rows corrected}. Only rows that differ are written, and
+    only for budgets that still exist.
+    """
+    catch_up(db, chunk_size)
+    params = {'tolerance': TOLERANCE}
+    with transaction(db):
+        # Events committed since catch_up() returned
+        while _replay_chunk(db, chunk_size) == chunk_size:
+            pass
+        changed = {}
+        changed['CategoryTotals'] = db.execute("""
+            UPDATE CategoryTotals
+            SET Planned = r.Planned, Spent = r.Spent,
+                ExpenseCount = r.ExpenseCount, TransactionCount = r.TransactionCount
+            FROM ReplayCategoryTotals r
+            WHERE r.BudgetID = CategoryTotals.BudgetID AND r.Category = CategoryTotals.Category
+              AND (ABS(r.Planned - CategoryTotals.Planned) > :tolerance
+                   OR ABS(r.Spent - CategoryTotals.Spent) > :tolerance
+                   OR r.ExpenseCount != CategoryTotals.ExpenseCount
+                   OR r.TransactionCount != CategoryTotals.TransactionCount)
+        """, params).rowcount
+        changed['CategoryTotals'] += db.execute("""
+            INSERT INTO CategoryTotals
+                (BudgetID, Category, Planned, Spent, ExpenseCount, TransactionCount)
+            SELECT r.BudgetID, r.Category, r.Planned, r.Spent, r.ExpenseCount, r.TransactionCount
+            FROM ReplayCategoryTotals r
+            JOIN Budget b ON b.BudgetID = r.BudgetID
+            WHERE NOT EXISTS (SELECT 1 FROM CategoryTotals c
+                              WHERE c.BudgetID = r.BudgetID AND c.Category = r.Category)
+        """).rowcount
+        changed['CategoryTotals'] += db.execute("""
+            DELETE FROM CategoryTotals
+            WHERE NOT EXISTS (SELECT 1 FROM ReplayCategoryTotals r
+                              WHERE r.BudgetID = CategoryTotals.BudgetID
+                                AND r.Category = CategoryTotals.Category)
+        """).rowcount
+
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS ReplayTouched (BudgetID INTEGER PRIMARY KEY)")
+        db.execute("DELETE FROM ReplayTouched")
+        db.execute("""
+            INSERT INTO ReplayTouched (BudgetID)
+            SELECT r.BudgetID
+            FROM ReplayBudgetTotals r
+            JOIN Budget b ON b.BudgetID = r.BudgetID
+            LEFT JOIN BudgetTotals bt ON bt.BudgetID = r.BudgetID
+            WHERE bt.BudgetID IS NULL
+               OR ABS(r.TransactionTotal - bt.TransactionTotal) > :tolerance
+               OR ABS(r.ExpenseTotal - bt.ExpenseTotal) > :tolerance
+               OR b.TotalTransactions IS NULL
+               OR ABS(r.TransactionTotal - b.TotalTransactions) > :tolerance
+        """, params)
+        changed['BudgetTotals'] = db.execute("""
+            INSERT INTO BudgetTotals (BudgetID, TransactionTotal, ExpenseTotal)
+            SELECT r.BudgetID, r.TransactionTotal, r.ExpenseTotal
+            FROM ReplayBudgetTotals r
+            WHERE r.BudgetID IN (SELECT BudgetID FROM ReplayTouched)
+            ON CONFLICT (BudgetID) DO UPDATE
+            SET TransactionTotal = excluded.TransactionTotal, ExpenseTotal = excluded.ExpenseTotal
+        """).rowcount
+        changed['BudgetTotals'] += db.execute("""
+            DELETE FROM BudgetTotals
+            WHERE NOT EXISTS (SELECT 1 FROM ReplayBudgetTotals r
+                              WHERE r.BudgetID = BudgetTotals.BudgetID)
+        """).rowcount
+        db.execute("""
+            UPDATE Budget SET TotalTransactions =
+                (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = Budget.BudgetID)
+            WHERE BudgetID IN (SELECT BudgetID FROM ReplayTouched)
+        """)
+    return changed
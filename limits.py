@@ -0,0 +1,98 @@
+# limits.py
+"""Budget limit checks applied atomically with the write they guard.
+
+Each write is a single conditional INSERT ... SELECT that only produces a
+row when the maintained totals (BudgetTotals/CategoryTotals) leave room for
+the new amount, run inside transaction() so no other writer can move the
+totals between the check and the insert. When nothing is inserted, the
+reason is looked up in the same transaction and raised as LimitExceeded.
+The budget has to be the user's: the INSERT ... SELECT matches on both ids,
+so a budget id from someone else's account writes nothing (LookupError).
+Both functions retry on busy errors, so callers only see a lock timeout if
+the database stays locked through every attempt.
+"""
+from db import retry_on_busy, transaction
+
+
+class LimitExceeded(Exception):
+    """The write was refused because it would break one of the budget's limits."""
+
+
+INSERT_TRANSACTION = """
+    INSERT INTO "Transaction" (Description, Category, Amount, Date, BudgetID)
+    SELECT :description, ct.Category, :amount, :date, b.BudgetID
+    FROM Budget b
+    JOIN CategoryTotals ct ON ct.BudgetID = b.BudgetID AND ct.Category = :category
+    LEFT JOIN BudgetTotals bt ON bt.BudgetID = b.BudgetID
+    WHERE b.BudgetID = :budget_id
+      AND b.UserID = :user_id
+      AND ct.ExpenseCount > 0
+      AND IFNULL(bt.TransactionTotal, 0) + :amount <= b.AccountLimit
+      AND ct.Spent + :amount <= ct.Planned
+"""
+
+INSERT_EXPENSE = """
+    INSERT INTO Expense (BudgetID, Category, Amount)
+    SELECT b.BudgetID, :category, :amount
+    FROM Budget b
+    LEFT JOIN BudgetTotals bt ON bt.BudgetID = b.BudgetID
+    WHERE b.BudgetID = :budget_id
+      AND b.UserID = :user_id
+      AND IFNULL(bt.ExpenseTotal, 0) + :amount <= b.AccountLimit
+"""
+
+
+def _budget(db, user_id, budget_id):
+    budget = db.execute("""
+        SELECT b.AccountLimit, IFNULL(bt.TransactionTotal, 0) AS TransactionTotal,
+               IFNULL(bt.ExpenseTotal, 0) AS ExpenseTotal
+        FROM Budget b
+        LEFT JOIN BudgetTotals bt ON bt.BudgetID = b.BudgetID
+        WHERE b.BudgetID = ? AND b.UserID = ?
+    """, (budget_id, user_id)).fetchone()
+    if budget is None:
+        raise LookupError(f"budget {budget_id} not found")
+    return budget
+
+
+def add_transaction(db, user_id, budget_id, description, category, amount, date):
+    """Insert a transaction into the user's budget unless it would exceed either limit.
+
+    Raises LookupError if the budget isn't the user's.
+    """
+    params = {'user_id': user_id, 'budget_id': budget_id, 'description': description, 'category': category,
+              'amount': amount, 'date': date}
+
+    def write():
+        with transaction(db):
+            if db.execute(INSERT_TRANSACTION, params).rowcount:
+                return
+            budget = _budget(db, user_id, budget_id)
+            if budget['TransactionTotal'] + amount > budget['AccountLimit']:
+                raise LimitExceeded("This transaction would exceed your overall account limit!")
+            if db.execute("""
+                SELECT 1 FROM CategoryTotals
+                WHERE BudgetID = ? AND Category = ? AND ExpenseCount > 0
+            """, (budget_id, category)).fetchone():
+                raise LimitExceeded(
+                    f"This transaction would exceed your budget for the '{category}' category!")
+            raise LimitExceeded(f"No defined expense for '{category}'.")
+
+    retry_on_busy(write)
+
+
+def add_expense(db, user_id, budget_id, category, amount):
+    """Insert a planned expense unless the budget's expenses would exceed its limit.
+
+    Raises LookupError if the budget isn't the user's.
+    """
+    params = {'user_id': user_id, 'budget_id': budget_id, 'category': category, 'amount': amount}
+
+    def write():
+        with transaction(db):
+            if db.execute(INSERT_EXPENSE, params).rowcount:
+                return
+            _budget(db, user_id, budget_id)
+            raise LimitExceeded("This expense would exceed your overall account limit!")
+
+    retry_on_busy(write)
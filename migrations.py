@@ -0,0 +1,612 @@
+# migrations.py
+"""Versioned schema migrations, tracked with SQLite's PRAGMA user_version.
+
+Each entry in MIGRATIONS is (version, description, sql). A database at
+user_version N gets every migration above N applied in order, each one in its
+own transaction together with the version bump, so a failed step leaves the
+schema at the last good version.
+"""
+import sqlite3
+
+MIGRATIONS = [
+    (1, "baseline schema", """
+        CREATE TABLE IF NOT EXISTS "User" (
+            "UserID" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "FirstName" TEXT NOT NULL,
+            "LastName" TEXT NOT NULL,
+            "AccountType" TEXT NOT NULL,
+            "Username" TEXT NOT NULL UNIQUE,
+            "Email" TEXT NOT NULL UNIQUE,
+            "Password" TEXT NOT NULL,
+            "TellerAccessToken" TEXT
+        );
+        CREATE TABLE IF NOT EXISTS "Account" (
+            "AccountID" INTEGER,
+            "Balance" REAL NOT NULL,
+            "UserID" INTEGER,
+            PRIMARY KEY("AccountID" AUTOINCREMENT)
+        );
+        CREATE TABLE IF NOT EXISTS "Goal" (
+            "GoalID" INTEGER,
+            "UserID" INTEGER,
+            "Amount" REAL NOT NULL,
+            PRIMARY KEY("GoalID" AUTOINCREMENT),
+            FOREIGN KEY("UserID") REFERENCES ""
+        );
+        CREATE TABLE IF NOT EXISTS "Budget" (
+            "BudgetID" INTEGER DEFAULT 100,
+            "AccountLimit" REAL NOT NULL,
+            "Month" TEXT NOT NULL,
+            "Year" INTEGER NOT NULL,
+            "UserID" INTEGER,
+            "Income" DECIMAL(10, 2) NOT NULL DEFAULT 0.00,
+            "TotalTransactions" INTEGER,
+            PRIMARY KEY("BudgetID" AUTOINCREMENT)
+        );
+        CREATE TABLE IF NOT EXISTS "Expense" (
+            "ExpenseID" INTEGER,
+            "Amount" REAL NOT NULL,
+            "Category" TEXT NOT NULL,
+            "BudgetID" INTEGER,
+            "TotalExpenses" REAL,
+            PRIMARY KEY("ExpenseID" AUTOINCREMENT),
+            FOREIGN KEY("BudgetID") REFERENCES "Budget"
+        );
+        CREATE TABLE IF NOT EXISTS "Transaction" (
+            "TransactionID" INTEGER UNIQUE,
+            "Amount" REAL NOT NULL,
+            "Date" DATE NOT NULL,
+            "Category" TEXT,
+            "Description" TEXT,
+            "BudgetID" INTEGER,
+            "TotalTransactions" INTEGER,
+            PRIMARY KEY("TransactionID")
+        );
+        CREATE TABLE IF NOT EXISTS "Rewards" (
+            "RewardID" INTEGER,
+            "Limit" INTEGER,
+            "amount" REAL,
+            "UserID" INTEGER,
+            PRIMARY KEY("RewardID" AUTOINCREMENT),
+            FOREIGN KEY("UserID") REFERENCES "User"("UserID")
+        );
+    """),
+    (2, "lookup indexes for route queries", """
+        CREATE INDEX IF NOT EXISTS idx_transaction_budget_category
+            ON "Transaction" (BudgetID, Category);
+        CREATE INDEX IF NOT EXISTS idx_transaction_budget_date
+            ON "Transaction" (BudgetID, Date);
+        CREATE INDEX IF NOT EXISTS idx_expense_budget_category
+            ON Expense (BudgetID, Category);
+        CREATE INDEX IF NOT EXISTS idx_budget_user_period
+            ON Budget (UserID, Year, Month);
+        CREATE INDEX IF NOT EXISTS idx_rewards_user
+            ON Rewards (UserID);
+    """),
+    (3, "trigger-maintained budget and category totals", """
+        CREATE TABLE IF NOT EXISTS BudgetTotals (
+            BudgetID INTEGER PRIMARY KEY,
+            TransactionTotal REAL NOT NULL DEFAULT 0,
+            ExpenseTotal REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS CategoryTotals (
+            BudgetID INTEGER NOT NULL,
+            Category TEXT NOT NULL,
+            Planned REAL NOT NULL DEFAULT 0,
+            Spent REAL NOT NULL DEFAULT 0,
+            ExpenseCount INTEGER NOT NULL DEFAULT 0,
+            TransactionCount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (BudgetID, Category)
+        ) WITHOUT ROWID;
+
+        INSERT OR REPLACE INTO BudgetTotals (BudgetID, TransactionTotal, ExpenseTotal)
+        SELECT b.BudgetID,
+               (SELECT COALESCE(SUM(Amount), 0) FROM "Transaction" WHERE BudgetID = b.BudgetID),
+               (SELECT COALESCE(SUM(Amount), 0) FROM Expense WHERE BudgetID = b.BudgetID)
+        FROM Budget b;
+        INSERT OR REPLACE INTO CategoryTotals
+            (BudgetID, Category, Planned, Spent, ExpenseCount, TransactionCount)
+        SELECT BudgetID, Category, SUM(Planned), SUM(Spent), SUM(ExpenseCount), SUM(TransactionCount)
+        FROM (
+            SELECT BudgetID, Category, Amount AS Planned, 0 AS Spent,
+                   1 AS ExpenseCount, 0 AS TransactionCount
+            FROM Expense
+            UNION ALL
+            SELECT BudgetID, IFNULL(Category, ''), 0, Amount, 0, 1
+            FROM "Transaction"
+        )
+        WHERE BudgetID IS NOT NULL
+        GROUP BY BudgetID, Category;
+        UPDATE Budget SET TotalTransactions =
+            (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = Budget.BudgetID);
+
+        CREATE TRIGGER IF NOT EXISTS trg_budget_insert_totals AFTER INSERT ON Budget
+        BEGIN
+            INSERT OR IGNORE INTO BudgetTotals (BudgetID) VALUES (NEW.BudgetID);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_budget_delete_totals AFTER DELETE ON Budget
+        BEGIN
+            DELETE FROM BudgetTotals WHERE BudgetID = OLD.BudgetID;
+            DELETE FROM CategoryTotals WHERE BudgetID = OLD.BudgetID;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_insert_totals AFTER INSERT ON "Transaction"
+        WHEN NEW.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO BudgetTotals (BudgetID, TransactionTotal) VALUES (NEW.BudgetID, NEW.Amount)
+                ON CONFLICT (BudgetID) DO UPDATE
+                SET TransactionTotal = TransactionTotal + excluded.TransactionTotal;
+            INSERT INTO CategoryTotals (BudgetID, Category, Spent, TransactionCount)
+                VALUES (NEW.BudgetID, IFNULL(NEW.Category, ''), NEW.Amount, 1)
+                ON CONFLICT (BudgetID, Category) DO UPDATE
+                SET Spent = Spent + excluded.Spent, TransactionCount = TransactionCount + 1;
+            UPDATE Budget SET TotalTransactions =
+                (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = NEW.BudgetID)
+            WHERE BudgetID = NEW.BudgetID;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_delete_totals AFTER DELETE ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL
+        BEGIN
+            UPDATE BudgetTotals SET TransactionTotal = TransactionTotal - OLD.Amount
+            WHERE BudgetID = OLD.BudgetID;
+            UPDATE CategoryTotals
+            SET Spent = Spent - OLD.Amount, TransactionCount = TransactionCount - 1
+            WHERE BudgetID = OLD.BudgetID AND Category = IFNULL(OLD.Category, '');
+            UPDATE Budget SET TotalTransactions =
+                (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = OLD.BudgetID)
+            WHERE BudgetID = OLD.BudgetID;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_update_totals
+        AFTER UPDATE OF Amount, Category, BudgetID ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL AND NEW.BudgetID IS NOT NULL
+        BEGIN
+            UPDATE BudgetTotals SET TransactionTotal = TransactionTotal - OLD.Amount
+            WHERE BudgetID = OLD.BudgetID;
+            UPDATE CategoryTotals
+            SET Spent = Spent - OLD.Amount, TransactionCount = TransactionCount - 1
+            WHERE BudgetID = OLD.BudgetID AND Category = IFNULL(OLD.Category, '');
+            INSERT INTO BudgetTotals (BudgetID, TransactionTotal) VALUES (NEW.BudgetID, NEW.Amount)
+                ON CONFLICT (BudgetID) DO UPDATE
+                SET TransactionTotal = TransactionTotal + excluded.TransactionTotal;
+            INSERT INTO CategoryTotals (BudgetID, Category, Spent, TransactionCount)
+                VALUES (NEW.BudgetID, IFNULL(NEW.Category, ''), NEW.Amount, 1)
+                ON CONFLICT (BudgetID, Category) DO UPDATE
+                SET Spent = Spent + excluded.Spent, TransactionCount = TransactionCount + 1;
+            UPDATE Budget SET TotalTransactions =
+                (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = Budget.BudgetID)
+            WHERE BudgetID IN (OLD.BudgetID, NEW.BudgetID);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_expense_insert_totals AFTER INSERT ON Expense
+        WHEN NEW.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO BudgetTotals (BudgetID, ExpenseTotal) VALUES (NEW.BudgetID, NEW.Amount)
+                ON CONFLICT (BudgetID) DO UPDATE
+                SET ExpenseTotal = ExpenseTotal + excluded.ExpenseTotal;
+            INSERT INTO CategoryTotals (BudgetID, Category, Planned, ExpenseCount)
+                VALUES (NEW.BudgetID, NEW.Category, NEW.Amount, 1)
+                ON CONFLICT (BudgetID, Category) DO UPDATE
+                SET Planned = Planned + excluded.Planned, ExpenseCount = ExpenseCount + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_expense_delete_totals AFTER DELETE ON Expense
+        WHEN OLD.BudgetID IS NOT NULL
+        BEGIN
+            UPDATE BudgetTotals SET ExpenseTotal = ExpenseTotal - OLD.Amount
+            WHERE BudgetID = OLD.BudgetID;
+            UPDATE CategoryTotals
+            SET Planned = Planned - OLD.Amount, ExpenseCount = ExpenseCount - 1
+            WHERE BudgetID = OLD.BudgetID AND Category = OLD.Category;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_expense_update_totals
+        AFTER UPDATE OF Amount, Category, BudgetID ON Expense
+        WHEN OLD.BudgetID IS NOT NULL AND NEW.BudgetID IS NOT NULL
+        BEGIN
+            UPDATE BudgetTotals SET ExpenseTotal = ExpenseTotal - OLD.Amount
+            WHERE BudgetID = OLD.BudgetID;
+            UPDATE CategoryTotals
+            SET Planned = Planned - OLD.Amount, ExpenseCount = ExpenseCount - 1
+            WHERE BudgetID = OLD.BudgetID AND Category = OLD.Category;
+            INSERT INTO BudgetTotals (BudgetID, ExpenseTotal) VALUES (NEW.BudgetID, NEW.Amount)
+                ON CONFLICT (BudgetID) DO UPDATE
+                SET ExpenseTotal = ExpenseTotal + excluded.ExpenseTotal;
+            INSERT INTO CategoryTotals (BudgetID, Category, Planned, ExpenseCount)
+                VALUES (NEW.BudgetID, NEW.Category, NEW.Amount, 1)
+                ON CONFLICT (BudgetID, Category) DO UPDATE
+                SET Planned = Planned + excluded.Planned, ExpenseCount = ExpenseCount + 1;
+        END;
+    """),
+    (4, "monthly per-category rollups", """
+        CREATE TABLE IF NOT EXISTS MonthlyRollup (
+            UserID INTEGER NOT NULL,
+            Year INTEGER NOT NULL,
+            Month INTEGER NOT NULL,
+            Category TEXT NOT NULL,
+            Planned REAL NOT NULL DEFAULT 0,
+            Spent REAL NOT NULL DEFAULT 0,
+            TransactionCount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (UserID, Year, Month, Category)
+        ) WITHOUT ROWID;
+
+        INSERT OR REPLACE INTO MonthlyRollup
+            (UserID, Year, Month, Category, Planned, Spent, TransactionCount)
+        SELECT b.UserID, b.Year, CAST(b.Month AS INTEGER), ct.Category,
+               SUM(ct.Planned), SUM(ct.Spent), SUM(ct.TransactionCount)
+        FROM CategoryTotals ct
+        JOIN Budget b ON b.BudgetID = ct.BudgetID
+        WHERE b.UserID IS NOT NULL
+        GROUP BY b.UserID, b.Year, CAST(b.Month AS INTEGER), ct.Category;
+
+        CREATE TRIGGER IF NOT EXISTS trg_category_totals_insert_rollup
+        AFTER INSERT ON CategoryTotals
+        BEGIN
+            INSERT INTO MonthlyRollup
+                (UserID, Year, Month, Category, Planned, Spent, TransactionCount)
+            SELECT b.UserID, b.Year, CAST(b.Month AS INTEGER), NEW.Category,
+                   NEW.Planned, NEW.Spent, NEW.TransactionCount
+            FROM Budget b
+            WHERE b.BudgetID = NEW.BudgetID AND b.UserID IS NOT NULL
+            ON CONFLICT (UserID, Year, Month, Category) DO UPDATE
+            SET Planned = Planned + excluded.Planned,
+                Spent = Spent + excluded.Spent,
+                TransactionCount = TransactionCount + excluded.TransactionCount;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_category_totals_update_rollup
+        AFTER UPDATE ON CategoryTotals
+        BEGIN
+            UPDATE MonthlyRollup
+            SET Planned = Planned - OLD.Planned + NEW.Planned,
+                Spent = Spent - OLD.Spent + NEW.Spent,
+                TransactionCount = TransactionCount - OLD.TransactionCount + NEW.TransactionCount
+            WHERE (UserID, Year, Month) =
+                  (SELECT UserID, Year, CAST(Month AS INTEGER) FROM Budget
+                   WHERE BudgetID = NEW.BudgetID)
+              AND Category = NEW.Category;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_category_totals_delete_rollup
+        AFTER DELETE ON CategoryTotals
+        BEGIN
+            UPDATE MonthlyRollup
+            SET Planned = Planned - OLD.Planned,
+                Spent = Spent - OLD.Spent,
+                TransactionCount = TransactionCount - OLD.TransactionCount
+            WHERE (UserID, Year, Month) =
+                  (SELECT UserID, Year, CAST(Month AS INTEGER) FROM Budget
+                   WHERE BudgetID = OLD.BudgetID)
+              AND Category = OLD.Category;
+        END;
+
+        -- A budget's contribution moves when it changes owner or period, and is
+        -- taken out before the budget is deleted (its CategoryTotals go after it).
+        CREATE TRIGGER IF NOT EXISTS trg_budget_delete_rollup BEFORE DELETE ON Budget
+        BEGIN
+            UPDATE MonthlyRollup
+            SET Planned = MonthlyRollup.Planned - ct.Planned,
+                Spent = MonthlyRollup.Spent - ct.Spent,
+                TransactionCount = MonthlyRollup.TransactionCount - ct.TransactionCount
+            FROM CategoryTotals ct
+            WHERE ct.BudgetID = OLD.BudgetID
+              AND MonthlyRollup.UserID = OLD.UserID
+              AND MonthlyRollup.Year = OLD.Year
+              AND MonthlyRollup.Month = CAST(OLD.Month AS INTEGER)
+              AND MonthlyRollup.Category = ct.Category;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_budget_update_rollup
+        AFTER UPDATE OF UserID, Year, Month ON Budget
+        BEGIN
+            UPDATE MonthlyRollup
+            SET Planned = MonthlyRollup.Planned - ct.Planned,
+                Spent = MonthlyRollup.Spent - ct.Spent,
+                TransactionCount = MonthlyRollup.TransactionCount - ct.TransactionCount
+            FROM CategoryTotals ct
+            WHERE ct.BudgetID = OLD.BudgetID
+              AND MonthlyRollup.UserID = OLD.UserID
+              AND MonthlyRollup.Year = OLD.Year
+              AND MonthlyRollup.Month = CAST(OLD.Month AS INTEGER)
+              AND MonthlyRollup.Category = ct.Category;
+            INSERT INTO MonthlyRollup
+                (UserID, Year, Month, Category, Planned, Spent, TransactionCount)
+            SELECT NEW.UserID, NEW.Year, CAST(NEW.Month AS INTEGER), ct.Category,
+                   ct.Planned, ct.Spent, ct.TransactionCount
+            FROM CategoryTotals ct
+            WHERE ct.BudgetID = NEW.BudgetID AND NEW.UserID IS NOT NULL
+            ON CONFLICT (UserID, Year, Month, Category) DO UPDATE
+            SET Planned = Planned + excluded.Planned,
+                Spent = Spent + excluded.Spent,
+                TransactionCount = TransactionCount + excluded.TransactionCount;
+        END;
+    """),
+    (5, "archived budget marker", """
+        CREATE TABLE IF NOT EXISTS ArchivedBudget (
+            BudgetID INTEGER PRIMARY KEY,
+            ArchivedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Moving an archived budget's transactions to the archive must leave its totals alone
+        DROP TRIGGER IF EXISTS trg_transaction_delete_totals;
+        CREATE TRIGGER trg_transaction_delete_totals AFTER DELETE ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL
+         AND NOT EXISTS (SELECT 1 FROM ArchivedBudget WHERE BudgetID = OLD.BudgetID)
+        BEGIN
+            UPDATE BudgetTotals SET TransactionTotal = TransactionTotal - OLD.Amount
+            WHERE BudgetID = OLD.BudgetID;
+            UPDATE CategoryTotals
+            SET Spent = Spent - OLD.Amount, TransactionCount = TransactionCount - 1
+            WHERE BudgetID = OLD.BudgetID AND Category = IFNULL(OLD.Category, '');
+            UPDATE Budget SET TotalTransactions =
+                (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = OLD.BudgetID)
+            WHERE BudgetID = OLD.BudgetID;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_budget_delete_archived AFTER DELETE ON Budget
+        BEGIN
+            DELETE FROM ArchivedBudget WHERE BudgetID = OLD.BudgetID;
+        END;
+    """),
+    (6, "month-end spending forecasts", """
+        CREATE TABLE IF NOT EXISTS Forecast (
+            BudgetID INTEGER NOT NULL,
+            Category TEXT NOT NULL,
+            DailyRate REAL NOT NULL,
+            Projected REAL NOT NULL,
+            Overspend INTEGER NOT NULL,
+            ComputedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (BudgetID, Category)
+        ) WITHOUT ROWID;
+
+        CREATE TRIGGER IF NOT EXISTS trg_budget_delete_forecast AFTER DELETE ON Budget
+        BEGIN
+            DELETE FROM Forecast WHERE BudgetID = OLD.BudgetID;
+        END;
+    """),
+    (7, "append-only event ledger with replayed totals", """
+        CREATE TABLE IF NOT EXISTS Ledger (
+            EventID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Kind TEXT NOT NULL,
+            BudgetID INTEGER NOT NULL,
+            EntityID INTEGER,
+            Category TEXT,
+            Amount REAL NOT NULL DEFAULT 0,
+            Count INTEGER NOT NULL DEFAULT 1,
+            Detail TEXT,
+            RecordedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_no_update BEFORE UPDATE ON Ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'Ledger is append-only');
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_no_delete BEFORE DELETE ON Ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'Ledger is append-only');
+        END;
+
+        -- Opening events for the rows that exist already. Archived transactions
+        -- are not visible here, so archived budgets carry their spending over as
+        -- one aggregate transaction_added event per category (EntityID NULL).
+        INSERT INTO Ledger (Kind, BudgetID, EntityID, Amount, Detail)
+        SELECT 'budget_opened', BudgetID, BudgetID, AccountLimit,
+               json_object('UserID', UserID, 'Year', Year, 'Month', Month, 'Income', Income)
+        FROM Budget ORDER BY BudgetID;
+        INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount)
+        SELECT 'expense_added', BudgetID, ExpenseID, Category, Amount
+        FROM Expense WHERE BudgetID IS NOT NULL ORDER BY ExpenseID;
+        INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount, Detail)
+        SELECT 'transaction_added', BudgetID, TransactionID, IFNULL(Category, ''), Amount,
+               json_object('Date', Date, 'Description', Description)
+        FROM "Transaction"
+        WHERE BudgetID IS NOT NULL
+          AND BudgetID NOT IN (SELECT BudgetID FROM ArchivedBudget)
+        ORDER BY TransactionID;
+        INSERT INTO Ledger (Kind, BudgetID, Category, Amount, Count)
+        SELECT 'transaction_added', BudgetID, Category, Spent, TransactionCount
+        FROM CategoryTotals
+        WHERE BudgetID IN (SELECT BudgetID FROM ArchivedBudget) AND TransactionCount != 0;
+
+        CREATE TRIGGER IF NOT EXISTS trg_budget_insert_ledger AFTER INSERT ON Budget
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Amount, Detail)
+            VALUES ('budget_opened', NEW.BudgetID, NEW.BudgetID, NEW.AccountLimit,
+                    json_object('UserID', NEW.UserID, 'Year', NEW.Year, 'Month', NEW.Month,
+                                'Income', NEW.Income));
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_budget_update_ledger
+        AFTER UPDATE OF UserID, Year, Month, AccountLimit, Income ON Budget
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Amount, Detail)
+            VALUES ('budget_changed', NEW.BudgetID, NEW.BudgetID, NEW.AccountLimit,
+                    json_object('UserID', NEW.UserID, 'Year', NEW.Year, 'Month', NEW.Month,
+                                'Income', NEW.Income));
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_budget_delete_ledger AFTER DELETE ON Budget
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID)
+            VALUES ('budget_deleted', OLD.BudgetID, OLD.BudgetID);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_expense_insert_ledger AFTER INSERT ON Expense
+        WHEN NEW.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount)
+            VALUES ('expense_added', NEW.BudgetID, NEW.ExpenseID, NEW.Category, NEW.Amount);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_expense_delete_ledger AFTER DELETE ON Expense
+        WHEN OLD.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount)
+            VALUES ('expense_removed', OLD.BudgetID, OLD.ExpenseID, OLD.Category, OLD.Amount);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_expense_update_ledger
+        AFTER UPDATE OF Amount, Category, BudgetID ON Expense
+        WHEN OLD.BudgetID IS NOT NULL AND NEW.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount)
+            VALUES ('expense_removed', OLD.BudgetID, OLD.ExpenseID, OLD.Category, OLD.Amount),
+                   ('expense_added', NEW.BudgetID, NEW.ExpenseID, NEW.Category, NEW.Amount);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_insert_ledger AFTER INSERT ON "Transaction"
+        WHEN NEW.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount, Detail)
+            VALUES ('transaction_added', NEW.BudgetID, NEW.TransactionID, IFNULL(NEW.Category, ''),
+                    NEW.Amount, json_object('Date', NEW.Date, 'Description', NEW.Description));
+        END;
+        -- Moving an archived budget's rows to the archive is not a removal
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_delete_ledger AFTER DELETE ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL
+         AND NOT EXISTS (SELECT 1 FROM ArchivedBudget WHERE BudgetID = OLD.BudgetID)
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount)
+            VALUES ('transaction_removed', OLD.BudgetID, OLD.TransactionID,
+                    IFNULL(OLD.Category, ''), OLD.Amount);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_update_ledger
+        AFTER UPDATE OF Amount, Category, BudgetID ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL AND NEW.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount, Detail)
+            VALUES ('transaction_removed', OLD.BudgetID, OLD.TransactionID,
+                    IFNULL(OLD.Category, ''), OLD.Amount, NULL),
+                   ('transaction_added', NEW.BudgetID, NEW.TransactionID, IFNULL(NEW.Category, ''),
+                    NEW.Amount, json_object('Date', NEW.Date, 'Description', NEW.Description));
+        END;
+
+        -- Totals as replayed from the ledger, and how far the replay has got
+        CREATE TABLE IF NOT EXISTS ReplayBudgetTotals (
+            BudgetID INTEGER PRIMARY KEY,
+            TransactionTotal REAL NOT NULL DEFAULT 0,
+            ExpenseTotal REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS ReplayCategoryTotals (
+            BudgetID INTEGER NOT NULL,
+            Category TEXT NOT NULL,
+            Planned REAL NOT NULL DEFAULT 0,
+            Spent REAL NOT NULL DEFAULT 0,
+            ExpenseCount INTEGER NOT NULL DEFAULT 0,
+            TransactionCount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (BudgetID, Category)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS LedgerCheckpoint (
+            Projection TEXT PRIMARY KEY,
+            EventID INTEGER NOT NULL,
+            UpdatedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """),
+    (8, "full-text search over transactions", """
+        -- Contentless: the text lives in "Transaction", the index only holds
+        -- tokens. BudgetID is indexed as a token so a search can be scoped to
+        -- one user's budgets inside the MATCH itself.
+        CREATE VIRTUAL TABLE IF NOT EXISTS TransactionSearch USING fts5(
+            Description, Category, BudgetID,
+            content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+        );
+        INSERT INTO TransactionSearch (rowid, Description, Category, BudgetID)
+        SELECT TransactionID, IFNULL(Description, ''), IFNULL(Category, ''), BudgetID
+        FROM "Transaction" WHERE BudgetID IS NOT NULL;
+
+        -- A contentless index can only drop a row given the exact values indexed
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_insert_search AFTER INSERT ON "Transaction"
+        WHEN NEW.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO TransactionSearch (rowid, Description, Category, BudgetID)
+            VALUES (NEW.TransactionID, IFNULL(NEW.Description, ''), IFNULL(NEW.Category, ''),
+                    NEW.BudgetID);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_delete_search AFTER DELETE ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL
+        BEGIN
+            INSERT INTO TransactionSearch (TransactionSearch, rowid, Description, Category, BudgetID)
+            VALUES ('delete', OLD.TransactionID, IFNULL(OLD.Description, ''),
+                    IFNULL(OLD.Category, ''), OLD.BudgetID);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_update_search
+        AFTER UPDATE OF TransactionID, Description, Category, BudgetID ON "Transaction"
+        BEGIN
+            INSERT INTO TransactionSearch (TransactionSearch, rowid, Description, Category, BudgetID)
+            SELECT 'delete', OLD.TransactionID, IFNULL(OLD.Description, ''),
+                   IFNULL(OLD.Category, ''), OLD.BudgetID
+            WHERE OLD.BudgetID IS NOT NULL;
+            INSERT INTO TransactionSearch (rowid, Description, Category, BudgetID)
+            SELECT NEW.TransactionID, IFNULL(NEW.Description, ''), IFNULL(NEW.Category, ''),
+                   NEW.BudgetID
+            WHERE NEW.BudgetID IS NOT NULL;
+        END;
+    """),
+    (9, "user shard placement and move fences", """
+        -- Directory column: the shard holding the user's budgets (NULL = shards.DEFAULT_SHARD)
+        ALTER TABLE User ADD COLUMN Shard TEXT;
+
+        -- Shard-side record of users moved away, so a request still routed
+        -- here by a stale lookup can't start new budgets in the old shard
+        CREATE TABLE IF NOT EXISTS ShardFence (
+            UserID INTEGER PRIMARY KEY,
+            MovedTo TEXT NOT NULL,
+            MovedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_budget_insert_fence BEFORE INSERT ON Budget
+        WHEN EXISTS (SELECT 1 FROM ShardFence WHERE UserID = NEW.UserID)
+        BEGIN
+            SELECT RAISE(ABORT, 'user has moved to another shard');
+        END;
+    """),
+    (10, "archive move marker", """
+        -- Budgets whose hot rows archive_budgets() is deleting right now. Filled
+        -- and emptied inside one write transaction, so no other connection sees
+        -- a row; a trigger can't read TEMP or attached tables, hence main.
+        CREATE TABLE IF NOT EXISTS ArchiveMove (
+            BudgetID INTEGER PRIMARY KEY
+        );
+
+        -- Only the move itself skips the totals: rows added to an archived
+        -- budget later and then deleted must still be taken off
+        DROP TRIGGER IF EXISTS trg_transaction_delete_totals;
+        CREATE TRIGGER trg_transaction_delete_totals AFTER DELETE ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL
+         AND NOT EXISTS (SELECT 1 FROM ArchiveMove WHERE BudgetID = OLD.BudgetID)
+        BEGIN
+            UPDATE BudgetTotals SET TransactionTotal = TransactionTotal - OLD.Amount
+            WHERE BudgetID = OLD.BudgetID;
+            UPDATE CategoryTotals
+            SET Spent = Spent - OLD.Amount, TransactionCount = TransactionCount - 1
+            WHERE BudgetID = OLD.BudgetID AND Category = IFNULL(OLD.Category, '');
+            UPDATE Budget SET TotalTransactions =
+                (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = OLD.BudgetID)
+            WHERE BudgetID = OLD.BudgetID;
+        END;
+    """),
+    (11, "ledger removals on archived budgets", """
+        -- As for the totals (10): only the archive move is not a removal
+        DROP TRIGGER IF EXISTS trg_transaction_delete_ledger;
+        CREATE TRIGGER trg_transaction_delete_ledger AFTER DELETE ON "Transaction"
+        WHEN OLD.BudgetID IS NOT NULL
+         AND NOT EXISTS (SELECT 1 FROM ArchiveMove WHERE BudgetID = OLD.BudgetID)
+        BEGIN
+            INSERT INTO Ledger (Kind, BudgetID, EntityID, Category, Amount)
+            VALUES ('transaction_removed', OLD.BudgetID, OLD.TransactionID,
+                    IFNULL(OLD.Category, ''), OLD.Amount);
+        END;
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db, target=None):
+    """Bring the database up to `target` (default: latest). Returns the versions applied."""
+    if target is None:
+        target = LATEST_VERSION
+    applied = []
+    current = schema_version(db)
+    for version, description, sql in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        try:
+            db.executescript(f"BEGIN; {sql}; PRAGMA user_version = {version}; COMMIT;")
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        applied.append((version, description))
+    return applied
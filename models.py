@@ -1,9 +1,34 @@
 # models.py
-from flask_login import UserMixin
 
-class User(UserMixin):
+# Columns needed to build a User; avoids loading the password hash and tokens
+USER_COLUMNS = "UserID, Username, FirstName, LastName"
+
+
+class User:
+    """The logged-in user as Flask-Login sees it.
+
+    Instances are cached and shared between requests, so they only carry the
+    four fields the app reads and are never modified after creation.
+    """
+    __slots__ = ('id', 'username', 'first_name', 'last_name')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
     def __init__(self, user_row):
         self.id = user_row['UserID']
         self.username = user_row['Username']
         self.first_name = user_row['FirstName']
         self.last_name = user_row['LastName']
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.get_id())
@@ -0,0 +1,116 @@
+# reports.py
+"""Printable monthly budget reports, rendered server-side.
+
+A report shows the same data as the budget charts page (load_budget_charts):
+planned and spent per category, drawn as bars in plain HTML/CSS, with no
+scripts or external assets, so it prints, saves to PDF from the browser and
+opens offline. Reports render with their own Jinja environment over the
+templates folder, so worker processes can render them without the Flask app.
+
+generate_reports() renders every budget of one month to REPORTS_FOLDER at
+month close. Budgets are listed on every shard, split into batches and
+handed to a spawn-context process pool: rendering is CPU work, and each
+worker opens its own connection to the batch's shard. workers=0 renders
+inline. Schedule it on the first of the month, e.g. from cron:
+
+    15 4 1 * *  cd /srv/smartex && flask generate-reports
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import multiprocessing
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import db as database
+import shards
+from dashboard_data import load_budget_charts
+
+BATCH_SIZE = 200
+DEFAULT_WORKERS = 2
+TEMPLATE = 'report.html'
+
+# What a worker process needs to open a shard like the app does
+DATABASE_CONFIG = ('DATABASE', 'SHARDS', 'ARCHIVE_DATABASE', 'SQLITE_BUSY_TIMEOUT_MS',
+                   'SQLITE_MMAP_SIZE', 'SQLITE_CACHE_SIZE_KB', 'SQL_INSTRUMENTATION')
+
+_environment = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+    autoescape=select_autoescape())
+
+
+def report_context(db, user_id, budget_id):
+    """Template context for a budget's report, or None if it isn't the user's."""
+    charts = load_budget_charts(db, user_id, budget_id)
+    if charts is None:
+        return None
+    planned, spent = {}, {}
+    for row in charts['expenses']:
+        planned[row['Category']] = planned.get(row['Category'], 0) + row['Amount']
+    for row in charts['transactions']:
+        spent[row['Category']] = row['Total']
+    scale = max([*planned.values(), *spent.values(), 0]) or 1
+    categories = [{'Category': category,
+                   'Planned': planned.get(category, 0),
+                   'Spent': spent.get(category, 0),
+                   'Remaining': planned.get(category, 0) - spent.get(category, 0),
+                   'PlannedWidth': round(100 * planned.get(category, 0) / scale, 1),
+                   'SpentWidth': round(100 * spent.get(category, 0) / scale, 1)}
+                  for category in sorted(planned.keys() | spent.keys())]
+    return {'budget': charts['budget'],
+            'categories': categories,
+            'planned_total': sum(planned.values()),
+            'spent_total': sum(spent.values()),
+            'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M')}
+
+
+def render_report(db, user_id, budget_id):
+    """The report's HTML, or None if the budget isn't the user's."""
+    context = report_context(db, user_id, budget_id)
+    return None if context is None else _environment.get_template(TEMPLATE).render(context)
+
+
+def _month_budgets(db, year, month):
+    return db.execute("""
+        SELECT UserID, BudgetID FROM Budget
+        WHERE Year = ? AND CAST(Month AS INTEGER) = ? AND UserID IS NOT NULL
+        ORDER BY BudgetID
+    """, (year, month)).fetchall()
+
+
+def _render_batch(config, path, budgets, folder):
+    """Render [(user, budget)] from the shard at `path` into `folder`; returns how many."""
+    db = database.open_database(config, path)
+    try:
+        for user_id, budget_id in budgets:
+            html = render_report(db, user_id, budget_id)
+            target = os.path.join(folder, f"user-{user_id}-budget-{budget_id}.html")
+            with open(target + '.part', 'w', encoding='utf-8') as out:
+                out.write(html)
+            os.replace(target + '.part', target)
+    finally:
+        db.close()
+    return len(budgets)
+
+
+def generate_reports(config, year, month, out_folder, workers=DEFAULT_WORKERS,
+                     batch_size=BATCH_SIZE):
+    """Render every budget of `year`-`month` into out_folder/YYYY-MM/; returns the count."""
+    config = {key: config[key] for key in DATABASE_CONFIG}
+    folder = os.path.join(out_folder, f"{year}-{month:02d}")
+    os.makedirs(folder, exist_ok=True)
+    batches = []
+    paths = shards.shard_paths(config)
+    for name, budgets in shards.fan_out(config, _month_budgets, year, month).items():
+        budgets = [tuple(row) for row in budgets]
+        batches += [(paths[name], budgets[start:start + batch_size])
+                    for start in range(0, len(budgets), batch_size)]
+
+    if not workers:
+        return sum(_render_batch(config, path, batch, folder) for path, batch in batches)
+    rendered = 0
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for future in as_completed([pool.submit(_render_batch, config, path, batch, folder)
+                                    for path, batch in batches]):
+            rendered += future.result()
+    return rendered
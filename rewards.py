@@ -0,0 +1,46 @@
+# rewards.py
+"""Reward settlement for closed budgets.
+
+A budget is closed once its month is over. Each closed budget earns one
+reward (stored with RewardID = BudgetID): 0.10 plus 5% of whatever was left
+unspent, if the budget was not overspent. settle_rewards() finds every
+closed budget without a reward and inserts the rewards in batches, straight
+from an INSERT ... SELECT, so running it again only picks up budgets that
+closed since. Schedule it daily, e.g. from cron:
+
+    0 1 * * *  cd /srv/smartex && flask settle-rewards
+"""
+from datetime import date
+
+from db import transaction
+
+BATCH_SIZE = 1000
+
+SETTLE_BATCH = """
+    INSERT OR IGNORE INTO Rewards (RewardID, UserID, Amount)
+    SELECT b.BudgetID, b.UserID,
+           0.10 + CASE
+               WHEN IFNULL(bt.TransactionTotal, 0) <= b.AccountLimit
+               THEN ROUND((b.AccountLimit - IFNULL(bt.TransactionTotal, 0)) * 0.05, 2)
+               ELSE 0
+           END
+    FROM Budget b
+    LEFT JOIN BudgetTotals bt ON bt.BudgetID = b.BudgetID
+    WHERE (b.Year < :year OR (b.Year = :year AND CAST(b.Month AS INTEGER) < :month))
+      AND NOT EXISTS (SELECT 1 FROM Rewards r WHERE r.RewardID = b.BudgetID)
+    ORDER BY b.BudgetID
+    LIMIT :batch_size
+"""
+
+
+def settle_rewards(db, today=None, batch_size=BATCH_SIZE):
+    """Reward every budget closed before `today`'s month; returns how many were settled."""
+    today = today or date.today()
+    params = {'year': today.year, 'month': today.month, 'batch_size': batch_size}
+    settled = 0
+    while True:
+        with transaction(db):
+            inserted = db.execute(SETTLE_BATCH, params).rowcount
+        settled += inserted
+        if inserted < batch_size:
+            return settled
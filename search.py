@@ -0,0 +1,126 @@
+# search.py
+"""Full-text search over a user's transactions, with filters and category facets.
+
+TransactionSearch (migration 8) is a contentless FTS5 index over each
+transaction's description and category, kept in step by triggers, with the
+BudgetID indexed as a token too. A search first lists the user's budgets
+(one index lookup), then puts them into the MATCH expression, so FTS5
+intersects the query terms with that user's rows instead of ranking every
+matching row in the table and filtering afterwards.
+
+All words of the query must match. The last word is matched as a prefix
+("groc" finds "Groceries") since it's usually still being typed; earlier
+words match whole tokens, which keeps FTS5 from merging the posting lists
+of every token they start. Results are ranked with bm25, descriptions
+weighing more than categories; with no words, the filters alone select
+rows, newest first. Archived transactions are searched through the
+archive's own index (see archive.index_archived) when it is attached.
+"""
+import re
+
+from archive import is_attached
+
+PAGE_SIZE = 25
+MAX_PAGE = 40
+MAX_WORDS = 8
+
+# bm25 column weights: Description, Category, BudgetID
+RANK = "bm25({table}, 2.0, 1.0, 0.0)"
+
+ARM = """
+    SELECT t.TransactionID, t.BudgetID, t.Date, t.Amount, t.Category, t.Description,
+           {rank} AS Rank
+    FROM {schema}.TransactionSearch
+    JOIN {schema}."Transaction" t ON t.TransactionID = TransactionSearch.rowid
+    WHERE TransactionSearch MATCH :match {filters}
+"""
+
+
+def _words(text):
+    return re.findall(r'\w+', text or '')[:MAX_WORDS]
+
+
+def build_match(text, budget_ids):
+    """FTS5 query: any of `budget_ids`, and every word of `text` (the last as a prefix)."""
+    match = 'BudgetID : (' + ' OR '.join(str(int(b)) for b in budget_ids) + ')'
+    words = _words(text)
+    if words:
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += '*'
+        match += ' AND {Description Category} : (' + ' AND '.join(terms) + ')'
+    return match
+
+
+def _filters(date_from, date_to, min_amount, max_amount):
+    clauses = []
+    if date_from is not None:
+        clauses.append("t.Date >= :date_from")
+    if date_to is not None:
+        clauses.append("t.Date <= :date_to")
+    if min_amount is not None:
+        clauses.append("t.Amount >= :min_amount")
+    if max_amount is not None:
+        clauses.append("t.Amount <= :max_amount")
+    return ''.join(f' AND {clause}' for clause in clauses)
+
+
+def _union(db, filters, ranked):
+    """The hot arm, plus the archive arm when the archive is attached."""
+    arms = [ARM.format(schema='main', filters=filters,
+                       rank=RANK.format(table='TransactionSearch') if ranked else '0')]
+    if is_attached(db):
+        # Rows caught mid-archival are in both stores; count the hot copy
+        arms.append(ARM.format(
+            schema='archive', rank=RANK.format(table='TransactionSearch') if ranked else '0',
+            filters=filters + ' AND NOT EXISTS (SELECT 1 FROM main."Transaction" m '
+                              'WHERE m.TransactionID = t.TransactionID)'))
+    return ' UNION ALL '.join(arms)
+
+
+def search_transactions(db, user_id, text='', date_from=None, date_to=None, min_amount=None,
+                        max_amount=None, category=None, page=1, per_page=PAGE_SIZE):
+    """One page of `user_id`'s transactions matching `text` and the filters.
+
+    Returns {'results', 'total', 'facets', 'page', 'next_page'}. Facets count
+    matches per category before the category filter is applied, so every
+    category stays selectable.
+    """
+    page = max(1, min(page, MAX_PAGE))
+    result = {'results': [], 'total': 0, 'facets': [], 'page': page, 'next_page': None}
+    budget_ids = [row[0] for row in db.execute(
+        "SELECT BudgetID FROM Budget WHERE UserID = ?", (user_id,))]
+    if not budget_ids:
+        return result
+
+    params = {'match': build_match(text, budget_ids), 'date_from': date_from,
+              'date_to': date_to, 'min_amount': min_amount, 'max_amount': max_amount,
+              'category': category, 'limit': per_page + 1,
+              'offset': (page - 1) * per_page}
+    filters = _filters(date_from, date_to, min_amount, max_amount)
+    ranked = bool(_words(text))
+
+    facets = db.execute(f"""
+        SELECT IFNULL(Category, '') AS Category, COUNT(*) AS Count
+        FROM ({_union(db, filters, ranked=False)})
+        GROUP BY 1
+        ORDER BY Count DESC, Category
+    """, params).fetchall()
+    result['facets'] = [dict(row) for row in facets]
+    result['total'] = sum(row['Count'] for row in facets
+                          if category is None or row['Category'] == category)
+
+    if category is not None:
+        filters += " AND IFNULL(t.Category, '') = :category"
+    order = "Rank, Date DESC, TransactionID DESC" if ranked else "Date DESC, TransactionID DESC"
+    rows = db.execute(f"""
+        SELECT TransactionID, BudgetID, Date, Amount, Category, Description
+        FROM ({_union(db, filters, ranked)})
+        ORDER BY {order}
+        LIMIT :limit OFFSET :offset
+    """, params).fetchall()
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        if page < MAX_PAGE:
+            result['next_page'] = page + 1
+    result['results'] = [dict(row) for row in rows]
+    return result
@@ -0,0 +1,318 @@
+# shards.py
+"""Sharding of user data across several SQLite files.
+
+One SQLite file has one write lock, so a single database serialises every
+user's writes. With SHARDS configured (SMARTEX_SHARDS="main=/srv/a.db,
+east=/srv/b.db"), each user's budgets, expenses, transactions and rewards
+live in one shard, and writes of users on different shards don't wait for
+each other. Every shard carries the full schema and its own triggers,
+totals, ledger and search index; the User table stays in the directory
+database (DATABASE), whose User.Shard column names each user's shard. Users
+from before sharding have no Shard and live in DEFAULT_SHARD, so name the
+shard holding the old database 'main'.
+
+New users are placed by consistent hashing of their UserID (HashRing).
+Adding a shard changes the ring's answer for only about 1/N of the users,
+and `flask rebalance-shards` moves exactly those, one at a time, online:
+
+1. the user's rows are copied into the target inside one write transaction
+   on the source, so their own writes wait for the copy while other users'
+   reads carry on. Rows go in through the target's triggers, which rebuild
+   its totals, rollups, ledger and search index; ids are renumbered by the
+   target's sequences, and archived transactions come back as hot rows
+   until the target's next archival run;
+2. the directory is pointed at the target, in the same transaction;
+3. the source rows are deleted and a ShardFence row stops a request that
+   looked the shard up just before the move from creating budgets there.
+
+SQLite commits attached WAL databases one file at a time, so a crash during
+the commit can leave a copy in a shard the directory doesn't point at;
+rebalance() purges such strays before moving anyone.
+
+fan_out() runs a query on every shard in parallel, for the batch jobs and
+cross-shard admin reports like shard_report().
+"""
+import bisect
+import functools
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db as database
+from archive import is_attached
+from db import DEFAULT_SHARD, retry_on_busy, shard_of, transaction
+
+VNODES = 128
+MAX_FAN_OUT = 8
+
+
+def parse_shards(value):
+    """SMARTEX_SHARDS ('name=path,name=path') as {name: path}; None when unset.
+
+    Raises ValueError for a malformed entry or when DEFAULT_SHARD isn't named.
+    """
+    if not value:
+        return None
+    shards = {}
+    for item in value.split(','):
+        name, sep, path = (part.strip() for part in item.partition('='))
+        if not sep or not name or not path:
+            raise ValueError(f"Bad shard {item!r}: expected name=path.")
+        shards[name] = os.path.abspath(path)
+    if DEFAULT_SHARD not in shards:
+        raise ValueError(f"SMARTEX_SHARDS has no {DEFAULT_SHARD!r} shard; users with no Shard "
+                         f"live there, so name the shard holding the old database "
+                         f"{DEFAULT_SHARD!r}.")
+    return shards
+
+
+def shard_paths(config):
+    """{name: path} of every shard; the single database when the app isn't sharded."""
+    return config['SHARDS'] or {DEFAULT_SHARD: config['DATABASE']}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of user ids onto shard names.
+
+    Each shard owns VNODES points on the ring, and a user belongs to the
+    first point at or after the hash of their id, so shards get even shares
+    and adding one only takes users from the others.
+    """
+
+    def __init__(self, names, vnodes=VNODES):
+        points = sorted((_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self._hashes = [point[0] for point in points]
+        self._names = [point[1] for point in points]
+
+    def shard_for(self, user_id):
+        index = bisect.bisect(self._hashes, _hash(str(user_id))) % len(self._hashes)
+        return self._names[index]
+
+
+@functools.lru_cache(maxsize=8)
+def _ring(names):
+    return HashRing(names)
+
+
+def place(config, user_id):
+    """The shard the ring assigns `user_id`; None when the app isn't sharded."""
+    shards = config['SHARDS']
+    return _ring(tuple(sorted(shards))).shard_for(user_id) if shards else None
+
+
+def fan_out(config, query, *args):
+    """Run `query(db, *args)` on every shard in parallel; returns {shard: result}.
+
+    Each call gets its own connection, closed when it returns.
+    """
+    shards = shard_paths(config)
+
+    def run(path):
+        db = database.open_database(config, path)
+        try:
+            return query(db, *args)
+        finally:
+            db.close()
+
+    workers = min(len(shards), MAX_FAN_OUT)
+    with ThreadPoolExecutor(workers, thread_name_prefix='shard') as pool:
+        return dict(zip(shards, pool.map(run, shards.values())))
+
+
+def shard_summary(db):
+    """Users, budgets, transactions (archived included), spending and size of one shard."""
+    summary = dict(db.execute("""
+        SELECT (SELECT COUNT(DISTINCT UserID) FROM Budget) AS Users,
+               (SELECT COUNT(*) FROM Budget) AS Budgets,
+               (SELECT COUNT(*) FROM AllTransactions) AS Transactions,
+               (SELECT ROUND(IFNULL(SUM(TransactionTotal), 0), 2) FROM BudgetTotals) AS Spent
+    """).fetchone())
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    summary['Bytes'] = page_count * db.execute("PRAGMA page_size").fetchone()[0]
+    return summary
+
+
+def shard_report(config):
+    """shard_summary() of every shard, gathered in parallel, plus a 'total' row."""
+    report = fan_out(config, shard_summary)
+    report['total'] = {column: sum(summary[column] for summary in report.values())
+                       for column in ('Users', 'Budgets', 'Transactions', 'Spent', 'Bytes')}
+    return report
+
+
+def _delete_user(db, schema, user_id):
+    """Delete the user's rows from `schema`, archived transactions included for main."""
+    budgets = f"SELECT BudgetID FROM {schema}.Budget WHERE UserID = :user"
+    params = {'user': user_id}
+    if schema == 'main' and is_attached(db):
+        db.execute(f"""
+            INSERT INTO archive.TransactionSearch
+                (TransactionSearch, rowid, Description, Category, BudgetID)
+            SELECT 'delete', a.TransactionID, IFNULL(a.Description, ''), IFNULL(a.Category, ''),
+                   a.BudgetID
+            FROM archive."Transaction" a
+            WHERE a.BudgetID IN ({budgets})
+              AND EXISTS (SELECT 1 FROM archive.TransactionSearch s WHERE s.rowid = a.TransactionID)
+        """, params)
+        db.execute(f'DELETE FROM archive."Transaction" WHERE BudgetID IN ({budgets})', params)
+    # Children before budgets, so the triggers unwind the totals row by row
+    db.execute(f'DELETE FROM {schema}."Transaction" WHERE BudgetID IN ({budgets})', params)
+    db.execute(f"DELETE FROM {schema}.Expense WHERE BudgetID IN ({budgets})", params)
+    for table in ('Rewards', 'Goal', 'Account', 'Budget', 'MonthlyRollup'):
+        db.execute(f"DELETE FROM {schema}.{table} WHERE UserID = :user", params)
+
+
+def _copy_user(db, user_id):
+    """Insert main's rows for the user into dest with new ids; returns the budget count."""
+    budget_ids = {}
+    for budget in db.execute("""
+        SELECT BudgetID, AccountLimit, Month, Year, Income, TotalTransactions
+        FROM main.Budget WHERE UserID = ? ORDER BY BudgetID
+    """, (user_id,)).fetchall():
+        budget_ids[budget['BudgetID']] = db.execute("""
+            INSERT INTO dest.Budget (AccountLimit, Month, Year, UserID, Income, TotalTransactions)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (budget['AccountLimit'], budget['Month'], budget['Year'], user_id,
+              budget['Income'], budget['TotalTransactions'])).lastrowid
+
+    budgets = "SELECT BudgetID FROM main.Budget WHERE UserID = ?"
+    db.executemany("""
+        INSERT INTO dest.Expense (Amount, Category, BudgetID, TotalExpenses) VALUES (?, ?, ?, ?)
+    """, [(row['Amount'], row['Category'], budget_ids[row['BudgetID']], row['TotalExpenses'])
+          for row in db.execute(f"""
+              SELECT Amount, Category, BudgetID, TotalExpenses FROM main.Expense
+              WHERE BudgetID IN ({budgets}) ORDER BY ExpenseID
+          """, (user_id,))])
+    db.executemany("""
+        INSERT INTO dest."Transaction" (Amount, Date, Category, Description, BudgetID)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(row['Amount'], row['Date'], row['Category'], row['Description'],
+           budget_ids[row['BudgetID']])
+          for row in db.execute(f"""
+              SELECT Amount, Date, Category, Description, BudgetID FROM AllTransactions
+              WHERE BudgetID IN ({budgets}) ORDER BY TransactionID
+          """, (user_id,))])
+    # A settled reward's id is its budget's id
+    db.executemany("""
+        INSERT INTO dest.Rewards (RewardID, "Limit", Amount, UserID) VALUES (?, ?, ?, ?)
+    """, [(budget_ids.get(row['RewardID']), row['Limit'], row['Amount'], user_id)
+          for row in db.execute("""
+              SELECT RewardID, "Limit", Amount FROM main.Rewards WHERE UserID = ?
+          """, (user_id,))])
+    db.execute("""
+        INSERT INTO dest.Goal (UserID, Amount) SELECT UserID, Amount FROM main.Goal WHERE UserID = ?
+    """, (user_id,))
+    db.execute("""
+        INSERT INTO dest.Account (Balance, UserID)
+        SELECT Balance, UserID FROM main.Account WHERE UserID = ?
+    """, (user_id,))
+    return len(budget_ids)
+
+
+def _same_file(a, b):
+    return os.path.realpath(a) == os.path.realpath(b)
+
+
+def move_user(config, user_id, target):
+    """Move `user_id`'s rows to shard `target` and route them there; returns budgets moved."""
+    shards = shard_paths(config)
+    if target not in shards:
+        raise LookupError(f"No shard named {target!r}.")
+    directory_path = config['DATABASE']
+    directory = database.open_database(config, directory_path)
+    try:
+        source = shard_of(directory, user_id)
+    finally:
+        directory.close()
+    if source == target:
+        return 0
+    database.open_database(config, shards[target]).close()  # migrated before it's attached
+
+    db = database.open_database(config, shards[source])
+    try:
+        db.execute("ATTACH DATABASE ? AS dest", (shards[target],))
+        if _same_file(directory_path, shards[source]):
+            users = 'main.User'
+        elif _same_file(directory_path, shards[target]):
+            users = 'dest.User'
+        else:
+            db.execute("ATTACH DATABASE ? AS directory", (directory_path,))
+            users = 'directory.User'
+
+        with transaction(db):
+            # Another mover got here first
+            shard = db.execute(f"SELECT IFNULL(Shard, ?) FROM {users} WHERE UserID = ?",
+                               (DEFAULT_SHARD, user_id)).fetchone()
+            if shard is None or shard[0] != source:
+                return 0
+            # 1. Copy, replacing anything an interrupted earlier move left in the target
+            _delete_user(db, 'dest', user_id)
+            db.execute("DELETE FROM dest.ShardFence WHERE UserID = ?", (user_id,))
+            moved = _copy_user(db, user_id)
+            # 2. Route the user to the target
+            db.execute(f"UPDATE {users} SET Shard = ? WHERE UserID = ?", (target, user_id))
+            # 3. Fence and clear the source
+            db.execute("""
+                INSERT INTO main.ShardFence (UserID, MovedTo) VALUES (?, ?)
+                ON CONFLICT (UserID) DO UPDATE
+                SET MovedTo = excluded.MovedTo, MovedAt = CURRENT_TIMESTAMP
+            """, (user_id, target))
+            _delete_user(db, 'main', user_id)
+        return moved
+    finally:
+        db.close()
+
+
+def purge_strays(config):
+    """Delete rows of users the directory places on another shard; returns {shard: users}."""
+    directory = database.open_database(config, config['DATABASE'])
+    try:
+        placement = dict(directory.execute(
+            "SELECT UserID, IFNULL(Shard, ?) FROM User", (DEFAULT_SHARD,)).fetchall())
+    finally:
+        directory.close()
+
+    purged = {}
+    for name, path in shard_paths(config).items():
+        db = database.open_database(config, path)
+        try:
+            strays = [user for (user,) in db.execute("SELECT DISTINCT UserID FROM Budget")
+                      if user is not None and placement.get(user, name) != name]
+            for user in strays:
+                def purge():
+                    with transaction(db):
+                        _delete_user(db, 'main', user)
+                retry_on_busy(purge)
+            purged[name] = len(strays)
+        finally:
+            db.close()
+    return purged
+
+
+def rebalance(config, limit=None, dry_run=False):
+    """Move users whose shard isn't the ring's choice; returns [(user, from, to)] moved.
+
+    Strays left by an interrupted move are purged first. With `dry_run`,
+    nothing is purged or moved and the list is what would move.
+    """
+    if not config['SHARDS']:
+        return []
+    directory = database.open_database(config, config['DATABASE'])
+    try:
+        users = directory.execute("""
+            SELECT UserID, IFNULL(Shard, ?) FROM User ORDER BY UserID
+        """, (DEFAULT_SHARD,)).fetchall()
+    finally:
+        directory.close()
+    moves = [(user, current, place(config, user)) for user, current in users
+             if place(config, user) != current][:limit]
+    if dry_run:
+        return moves
+    purge_strays(config)
+    for user, _, target in moves:
+        retry_on_busy(lambda: move_user(config, user, target))
+    return moves
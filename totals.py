@@ -0,0 +1,96 @@
+# totals.py
+"""Reconciliation for the trigger-maintained BudgetTotals/CategoryTotals tables.
+
+The triggers in migration 3 keep the totals in step with every write, so the
+routes can check limits with a key lookup instead of re-summing. reconcile()
+recomputes the same figures from the raw Transaction/Expense rows, reports any
+drift and (unless told not to) rewrites the totals from scratch. Raw rows are
+read through the AllTransactions view, so archived transactions still count.
+"""
+from db import install_views, transaction
+
+# Allowed difference between a maintained total and the raw sum, to absorb
+# float rounding from adding amounts one at a time.
+TOLERANCE = 0.005
+
+EXPECTED_BUDGET_TOTALS = """
+    SELECT b.BudgetID,
+           (SELECT COALESCE(SUM(Amount), 0) FROM AllTransactions WHERE BudgetID = b.BudgetID)
+               AS TransactionTotal,
+           (SELECT COALESCE(SUM(Amount), 0) FROM Expense WHERE BudgetID = b.BudgetID)
+               AS ExpenseTotal
+    FROM Budget b
+"""
+
+EXPECTED_CATEGORY_TOTALS = """
+    SELECT BudgetID, Category,
+           SUM(Planned) AS Planned, SUM(Spent) AS Spent,
+           SUM(ExpenseCount) AS ExpenseCount, SUM(TransactionCount) AS TransactionCount
+    FROM (
+        SELECT BudgetID, Category, Amount AS Planned, 0 AS Spent,
+               1 AS ExpenseCount, 0 AS TransactionCount
+        FROM Expense
+        UNION ALL
+        SELECT BudgetID, IFNULL(Category, ''), 0, Amount, 0, 1
+        FROM AllTransactions
+    )
+    WHERE BudgetID IS NOT NULL
+    GROUP BY BudgetID, Category
+"""
+
+
+def _diff(expected, actual, key_names, value_names):
+    drift = []
+    zero = dict.fromkeys(value_names, 0)
+    for key in sorted(expected.keys() | actual.keys(), key=repr):
+        want = expected.get(key, zero)
+        have = actual.get(key, zero)
+        for name in value_names:
+            if abs((want[name] or 0) - (have[name] or 0)) > TOLERANCE:
+                entry = dict(zip(key_names, key))
+                entry.update(column=name, expected=want[name], actual=have[name])
+                drift.append(entry)
+    return drift
+
+
+def find_drift(db):
+    """Compare maintained totals against the raw rows and list every mismatch."""
+    install_views(db)
+    budget_values = ('TransactionTotal', 'ExpenseTotal')
+    category_values = ('Planned', 'Spent', 'ExpenseCount', 'TransactionCount')
+
+    expected = {(r['BudgetID'],): r for r in db.execute(EXPECTED_BUDGET_TOTALS)}
+    actual = {(r['BudgetID'],): r for r in db.execute("SELECT * FROM BudgetTotals")}
+    drift = [dict(entry, table='BudgetTotals')
+             for entry in _diff(expected, actual, ('BudgetID',), budget_values)]
+
+    expected = {(r['BudgetID'], r['Category']): r for r in db.execute(EXPECTED_CATEGORY_TOTALS)}
+    actual = {(r['BudgetID'], r['Category']): r
+              for r in db.execute("SELECT * FROM CategoryTotals")}
+    drift += [dict(entry, table='CategoryTotals')
+              for entry in _diff(expected, actual, ('BudgetID', 'Category'), category_values)]
+    return drift
+
+
+def rebuild(db):
+    """Recompute all totals from the raw rows in a single transaction."""
+    install_views(db)
+    with transaction(db):
+        db.execute("DELETE FROM BudgetTotals")
+        db.execute("DELETE FROM CategoryTotals")
+        db.execute(f"INSERT INTO BudgetTotals (BudgetID, TransactionTotal, ExpenseTotal) "
+                   f"{EXPECTED_BUDGET_TOTALS}")
+        db.execute(f"INSERT INTO CategoryTotals (BudgetID, Category, Planned, Spent, "
+                   f"ExpenseCount, TransactionCount) {EXPECTED_CATEGORY_TOTALS}")
+        db.execute("""
+            UPDATE Budget SET TotalTransactions =
+                (SELECT TransactionTotal FROM BudgetTotals WHERE BudgetID = Budget.BudgetID)
+        """)
+
+
+def reconcile(db, fix=True):
+    """Report drift between maintained and raw totals, rebuilding them when fix is set."""
+    drift = find_drift(db)
+    if drift and fix:
+        rebuild(db)
+    return drift